@@ -0,0 +1,135 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Persistent index of 21cmFAST-cache files. Only the HDF5 attributes of each
+cache file (redshift, random seed and input parameter groups) are read, and
+the resulting (redshift, random_seed, params) -> path mapping is stored as
+json next to the cache. The index is refreshed incrementally: only files that
+are new or whose mtime changed are re-read.
+
+'''
+
+import os
+import json
+import h5py
+import hashlib
+import numpy as np
+from glob import glob
+
+def z_key(redshift):
+
+    '''Function to return the float32-rounded redshift used to match boxes.'''
+
+    return float(np.float32(redshift))
+
+def read_cache_attrs(fname):
+
+    '''
+    Function to read the redshift, random seed and a hash of the input
+    parameter groups of a 21cmFAST cache file, without reading any boxes.
+    '''
+
+    with h5py.File(fname, 'r') as hf:
+
+        redshift = hf.attrs.get('redshift')
+        random_seed = hf.attrs.get('random_seed')
+
+        # Input parameters are stored as attributes of top-level groups
+        params = {}
+        for k in sorted(hf.keys()):
+            if isinstance(hf[k], h5py.Group) and (k.endswith('params') or k == 'flag_options'):
+                params[k] = {kk: str(v) for kk, v in sorted(hf[k].attrs.items())}
+
+    return {'redshift': None if redshift is None else float(redshift),
+            'random_seed': None if random_seed is None else int(random_seed),
+            'params': hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()}
+
+class CacheIndex:
+
+    """
+    Index of the 21cmFAST-cache files of one output structure.
+    ----------
+    Attributes
+    :cache_dir:  (str) 21cmFAST-cache directory.
+    :pattern:    (str) Glob pattern of the indexed files.
+    :index_file: (str) Path of the persisted json index.
+    :entries:    (dict) path -> {'mtime', 'redshift', 'random_seed', 'params'}.
+    """
+
+    def __init__(self, cache_dir: str, pattern: str = 'PerturbHaloField*',
+                 index_file: str = None):
+
+        self.cache_dir = cache_dir
+        self.pattern = pattern
+        self.index_file = index_file or os.path.join(cache_dir, f".index_{pattern.strip('*')}.json")
+        self.entries = {}
+
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.entries = json.load(f)
+
+        self.refresh()
+
+    def refresh(self):
+        """Re-reads the attributes of new or modified files, drops deleted ones"""
+
+        paths = glob(os.path.join(self.cache_dir, self.pattern))
+        updated = False
+
+        for path in set(self.entries) - set(paths):
+            del self.entries[path]
+            updated = True
+
+        for path in paths:
+            mtime = os.path.getmtime(path)
+            if path in self.entries and self.entries[path]['mtime'] == mtime:
+                continue
+            try:
+                entry = read_cache_attrs(path)
+            except OSError:
+                continue # file still being written
+            entry['mtime'] = mtime
+            self.entries[path] = entry
+            updated = True
+
+        if updated:
+            self.save()
+
+    def save(self):
+        """Writes the index to index_file atomically"""
+
+        tmp_name = self.index_file + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_name, self.index_file)
+
+    def lookup(self, redshift: float, random_seed: int, params: str = None):
+        """Returns the paths of cache files matching (redshift, random_seed[, params])"""
+
+        return [path for path, e in sorted(self.entries.items())
+                if e['random_seed'] == int(random_seed)
+                and e['redshift'] is not None and z_key(e['redshift']) == z_key(redshift)
+                and (params is None or e['params'] == params)]
+
+    def join(self, redshifts, random_seeds):
+        """
+        Hash-map join of (redshifts[i], random_seeds[i]) pairs against the index.
+        Returns a list of (i, path) for every cache file matching pair i.
+        """
+
+        table = {}
+        for path, e in sorted(self.entries.items()):
+            if e['redshift'] is not None and e['random_seed'] is not None:
+                table.setdefault((z_key(e['redshift']), e['random_seed']), []).append(path)
+
+        matches = []
+        for i, (z, rseed) in enumerate(zip(redshifts, random_seeds)):
+            for path in table.get((z_key(z), int(rseed)), []):
+                matches.append((i, path))
+
+        return matches
@@ -3,38 +3,97 @@ Script for saving/loading h5 datafiles
 @author: j-c-carr
 """
 
+import os
 import h5py
+import queue
+import threading
 import numpy as np
 from pprint import pprint
+from typing import Optional, List
+from dtype_policy import get_policy
 
 class DataManager:
 
     """
     Loads data from h5py file. Datasets from the h5py file are stored in the
     DataManager.data dictionary. Data from h5py Groups are store in the
-    DataManager.metadata dictionary. 
+    DataManager.metadata dictionary.
+
+    Datasets are loaded with the field dtype of the precision policy (float32
+    by default, see dtype_policy.py).
+
+    With lazy=True the h5py file is kept open and DataManager.data holds
+    on-disk views instead of in-memory copies: contiguous, unfiltered datasets
+    are memory-mapped directly (np.memmap) and all others are left as
+    h5py Datasets, so DM.data["ionized_boxes"][k] only reads box k. Lazy
+    views keep the dtype stored in the file. Call close() (or use the
+    DataManager as a context manager) when done.
+
+    keys restricts which datasets are loaded and index selects boxes along
+    the first axis of every loaded dataset, so only those slices are read:
+        zs = DataManager(fpath, keys=["redshifts"]).data["redshifts"]
+        DM = DataManager(fpath, keys=["ionized_boxes"], index=[3])
+
+    iter_boxes streams aligned batches of boxes (and their redshifts, seeds)
+    with the next batch read on a background thread, and map writes the
+    result of a function applied per batch to a new h5py file, so stacks
+    larger than memory can be processed with lazy=True:
+        with DataManager(fpath, lazy=True) as DM:
+            for batch in DM.iter_boxes(["ionized_boxes"], batch=8):
+                ...
     ----------
     Attributes
     :filepath:   (str) Name of h5py file.
-    :data:       (dict) All h5py Datasets (retrieved as numpy arrays) loaded 
-                        from the h5py file. 
+    :lazy:       (bool) If True, datasets are read on demand.
+    :keys:       (list) Datasets to load, all if None.
+    :index:      (array) Indices along the first axis to load, all if None.
+    :data:       (dict) All h5py Datasets (retrieved as numpy arrays) loaded
+                        from the h5py file.
     :dset_attrs: (dict) Stores h5py datafile attributes.
     :metadata:   (dict) Stores h5py Group data (retrieved as numpy arrays).
     """
 
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, lazy: bool = False, mmap: bool = True,
+                 keys: Optional[List[str]] = None, index=None):
         assert filepath[-3:] == ".h5", "filepath must point to an h5 file."
+        assert not (lazy and index is not None), \
+            "index is not supported in lazy mode, slice DataManager.data instead."
 
         self.filepath = filepath
+        self.lazy = lazy
+        self.mmap = mmap
+        self.keys = keys
+        self.index = index
         self.data = {}
         self.dset_attrs = {}
         self.metadata = {}
+        self._hf = None
+
+        if self.lazy:
+            self.open_data_from_h5()
+        else:
+            self.load_data_from_h5()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Closes the h5py file held open in lazy mode"""
+
+        if self._hf is not None:
+            # Drop views first so no memmap/Dataset outlives the file handle
+            self.data = {}
+            self._hf.close()
+            self._hf = None
 
-        self.load_data_from_h5()
-        
     def load_data_from_h5(self):
         """Loads all data from h5 file into numpy arrays"""
 
+        dtype = get_policy().field
+
         with h5py.File(self.filepath, "r") as hf:
 
             for k in hf.keys():
@@ -43,12 +102,12 @@ class DataManager:
                 if isinstance(hf[k], h5py.Group):
                     self.metadata[k] = {}
                     for k2 in hf[k].keys():
-                        v = np.array(hf[k][k2], dtype=np.float32)
+                        v = np.array(hf[k][k2], dtype=dtype)
                         self.metadata[k][k2] = v
 
                 # Lightcone data is stored as h5py datasets
-                if isinstance(hf[k], h5py.Dataset):
-                    v = np.array(hf[k][:], dtype=np.float32)
+                if isinstance(hf[k], h5py.Dataset) and self._wanted(k):
+                    v = np.array(self._read_rows(hf[k]), dtype=dtype)
                     #assert np.isnan(np.sum(v)) is False, \
                           # f"Error, {k} has nan values."
                     self.data[k] = v
@@ -57,12 +116,200 @@ class DataManager:
             for k, v in hf.attrs.items():
                 self.dset_attrs[k] = v
 
-        # Print success message
+        self.print_summary()
+
+    def open_data_from_h5(self):
+        """Opens h5 file and maps datasets without reading them into memory"""
+
+        self._hf = h5py.File(self.filepath, "r")
+
+        for k in self._hf.keys():
+
+            # Group data is small, load it eagerly as in load_data_from_h5
+            if isinstance(self._hf[k], h5py.Group):
+                self.metadata[k] = {}
+                for k2 in self._hf[k].keys():
+                    v = np.array(self._hf[k][k2], dtype=get_policy().field)
+                    self.metadata[k][k2] = v
+
+            if isinstance(self._hf[k], h5py.Dataset) and self._wanted(k):
+                self.data[k] = self._map_dataset(self._hf[k])
+
+        for k, v in self._hf.attrs.items():
+            self.dset_attrs[k] = v
+
+        self.print_summary()
+
+    def _wanted(self, k: str) -> bool:
+        """Returns True if dataset k should be loaded"""
+
+        return self.keys is None or k in self.keys
+
+    def _read_rows(self, dset: h5py.Dataset):
+        """
+        Reads dset, or only the rows of self.index along its first axis.
+        h5py needs increasing, unique indices, so rows are read sorted and
+        returned in the requested order.
+        """
+
+        if self.index is None or dset.shape == ():
+            return dset[()]
+
+        index = np.atleast_1d(self.index)
+        rows, inverse = np.unique(index, return_inverse=True)
+
+        return dset[rows][inverse.reshape(-1)]
+
+    def _map_dataset(self, dset: h5py.Dataset):
+        """
+        Returns a read-only np.memmap over dset if its HDF5 layout allows it
+        (contiguous, unfiltered, allocated), otherwise the h5py Dataset itself.
+        Scalar datasets are read directly.
+        """
+
+        if dset.shape == ():
+            return dset[()]
+
+        if self.mmap and dset.chunks is None and dset.dtype.kind in "biuf":
+            offset = dset.id.get_offset()
+            if offset is not None:
+                return np.memmap(self.filepath, mode="r", dtype=dset.dtype,
+                                 shape=dset.shape, offset=offset)
+
+        return dset
+
+    def _aligned_keys(self, keys, num_boxes):
+        """1-D datasets with one entry per box, e.g. redshifts and random seeds"""
+
+        return [k for k, v in self.data.items()
+                if k not in keys and np.ndim(v) == 1 and len(v) == num_boxes]
+
+    def _iter_batches(self, keys, batch, dtype, aligned):
+        """Yields aligned batches read into memory, see iter_boxes"""
+
+        num_boxes = len(self.data[keys[0]])
+        for start in range(0, num_boxes, batch):
+            stop = min(start + batch, num_boxes)
+            # np.array copies, so memmaps/h5py Datasets are read here and not by the consumer
+            out = {k: np.array(self.data[k][start:stop], dtype=dtype) for k in keys}
+            out.update({k: np.array(self.data[k][start:stop]) for k in aligned})
+            out['index'] = np.arange(start, stop)
+            yield out
+
+    def iter_boxes(self, keys: List[str], batch: int = 1, dtype=None,
+                   aligned: Optional[List[str]] = None, prefetch: bool = True):
+        """
+        Yields aligned batches of boxes as dicts {key: array of up to batch
+        boxes, ..., 'index': indices of the boxes along the first axis}. 1-D
+        datasets with one entry per box (redshifts, random seeds, ...) are
+        included, or only those in aligned if given. With prefetch, the next
+        batch is read on a background thread while the current one is used,
+        so at most two batches are in memory.
+        """
+
+        keys = list(keys)
+        for k in keys:
+            if k not in self.data:
+                raise KeyError(f"{k} not loaded from {self.filepath}.")
+        num_boxes = len(self.data[keys[0]])
+        assert all(len(self.data[k]) == num_boxes for k in keys), \
+            "datasets must have the same number of boxes."
+        if aligned is None:
+            aligned = self._aligned_keys(keys, num_boxes)
+
+        batches = self._iter_batches(keys, batch, dtype, aligned)
+        if not prefetch:
+            yield from batches
+            return
+
+        # Reader thread keeps one batch ready ahead of the consumer
+        ready = queue.Queue(maxsize=1)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # Gives up once the consumer has stopped, so the thread never blocks forever
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def reader():
+            try:
+                for out in batches:
+                    if not put(out):
+                        return
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                out = ready.get()
+                if out is done:
+                    break
+                if isinstance(out, BaseException):
+                    raise out
+                yield out
+        finally:
+            stop.set()
+            thread.join()
+
+    def map(self, func, filename: str, keys: List[str], batch: int = 1, dtype=None,
+            **storage_kwargs):
+        """
+        Applies func to every batch of iter_boxes(keys, batch) and writes the
+        results to a new h5py file. func returns a dict {name: array} with one
+        entry per box of the batch along the first axis. Output datasets are
+        created from the first batch and chunked per box (storage_kwargs are
+        passed to utility_funcs.box_storage_kwargs); the aligned 1-D datasets
+        and the file attributes are copied over. The file is written to a
+        temporary name and renamed when complete.
+        """
+
+        from utility_funcs import box_storage_kwargs
+
+        num_boxes = len(self.data[keys[0]])
+        aligned = self._aligned_keys(list(keys), num_boxes)
+
+        tmp_name = filename + ".tmp"
+        with h5py.File(tmp_name, "w") as hf:
+
+            for out in self.iter_boxes(keys, batch=batch, dtype=dtype, aligned=aligned):
+
+                results = func(out)
+                start, stop = out['index'][0], out['index'][-1] + 1
+
+                for k, v in results.items():
+                    v = np.asarray(v)
+                    if k not in hf:
+                        hf.create_dataset(k, **box_storage_kwargs((num_boxes,) + v.shape[1:], v.dtype,
+                                                                  **storage_kwargs))
+                    hf[k][start:stop] = v
+
+            for k in aligned:
+                hf.create_dataset(k, data=np.asarray(self.data[k]))
+            for k, v in self.dset_attrs.items():
+                hf.attrs[k] = v
+
+        os.replace(tmp_name, filename)
+
+        return filename
+
+    def print_summary(self):
+        """Prints the datasets, metadata and attributes held by the DataManager"""
+
         print("\n----------\n")
         print(f"data loaded from {self.filepath}")
         print("Contents:")
         for k, v in self.data.items():
-            print("\t{}, shape: {}".format(k, v.shape))
+            print("\t{}, shape: {}".format(k, np.shape(v)))
         print("\nMetadata:")
         for k in self.metadata.keys():
             print(f"\t{k}")
@@ -70,4 +317,4 @@ class DataManager:
         print("\nDataset Attributes:")
         for k in self.dset_attrs.keys():
             print(f"\t{k}")
-        print("\n----------\n")
\ No newline at end of file
+        print("\n----------\n")
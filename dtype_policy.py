@@ -0,0 +1,158 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Single, configurable precision policy for the arrays of the pipeline. The
+default 'float32' policy stores halo coordinates as uint16/int16 grid indices,
+halo masses and fields (ionization boxes, galaxy fields) as float32 and masks
+as bool, halving or quartering memory and I/O; 'float64' reproduces the
+original float64 path. Sums and interpolations are still accumulated in
+float64, only stored arrays follow the policy.
+
+The policy is chosen with the GALAXY_MAPPING_PRECISION environment variable
+or set_policy(), and used by binarize_boxes, get_n_i_halo_mass_coords,
+DataManager, the training-set builder and the lightcone-gen survey fields.
+check_policy() (or running this module) verifies that output statistics of
+the active policy match the float64 path within tolerance.
+
+'''
+
+import os
+import sys
+import numpy as np
+
+POLICIES = {'float32': {'coords': np.uint16, 'mass': np.float32, 'field': np.float32, 'mask': np.bool_},
+            'float64': {'coords': np.float64, 'mass': np.float64, 'field': np.float64, 'mask': np.float64}}
+
+class DtypePolicy:
+
+    """
+    Dtypes of the arrays stored by the pipeline.
+    ----------
+    Attributes
+    :name:   (str) Policy name, a key of POLICIES.
+    :coords: (dtype) Halo grid coordinates.
+    :mass:   (dtype) Halo masses.
+    :field:  (dtype) Ionization boxes and galaxy / halo mass fields.
+    :mask:   (dtype) Binarized (neutral / ionized) boxes.
+    """
+
+    def __init__(self, name: str = 'float32'):
+
+        if name not in POLICIES:
+            raise ValueError(f"Unknown precision policy {name}, choose from {list(POLICIES)}.")
+
+        self.name = name
+        for k, v in POLICIES[name].items():
+            setattr(self, k, np.dtype(v))
+
+    def __repr__(self):
+        return f"DtypePolicy('{self.name}')"
+
+    def coords_dtype(self, coords):
+        """
+        Dtype of an array of grid coordinates: the policy's integer type if the
+        values fit (int16 for negative coordinates), otherwise int32.
+        """
+
+        if self.coords.kind == 'f':
+            return self.coords
+
+        coords = np.asarray(coords)
+        if coords.size == 0:
+            return self.coords
+        lo, hi = coords.min(), coords.max()
+        for dtype in (self.coords, np.dtype(np.int16)):
+            info = np.iinfo(dtype)
+            if info.min <= lo and hi <= info.max:
+                return dtype
+
+        return np.dtype(np.int32)
+
+_policy = DtypePolicy(os.environ.get('GALAXY_MAPPING_PRECISION', 'float32'))
+
+def get_policy():
+
+    '''Function to return the active DtypePolicy.'''
+
+    return _policy
+
+def set_policy(name: str):
+
+    '''Function to set the active DtypePolicy by name, returns the previous one.'''
+
+    global _policy
+    previous, _policy = _policy, DtypePolicy(name)
+
+    return previous
+
+def check_policy(name: str = None, rtol: float = 1e-5, HII_DIM: int = 32, num_halos: int = 20000,
+                 seed: int = 0):
+
+    '''
+    Function to check that the output statistics of policy name (the active
+    one if None) match the float64 path within rtol, on synthetic boxes and
+    halos: binarized boxes, sorted halo counts, coordinates and mass sums,
+    and survey galaxy field counts and mass sums. Raises AssertionError on a
+    mismatch, returns the largest relative difference of the mass sums.
+    '''
+
+    from utility_funcs import (binarize_boxes, sort_n_i_halos)
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lightcone-gen'))
+    from survey_selection import (SurveySelection, SURVEY_CUTOFFS)
+
+    rng = np.random.default_rng(seed)
+    xH_boxes = rng.random((2, HII_DIM, HII_DIM, HII_DIM), dtype=np.float32)
+    halo_coords = rng.integers(0, 3 * HII_DIM, (num_halos, 3))
+    halo_masses = 10**rng.uniform(8, 12, num_halos)
+    mags = rng.uniform(24, 34, num_halos)
+    flat_inds = np.ravel_multi_index(tuple((halo_coords // 3).T), (HII_DIM,)*3)
+    selection = SurveySelection(SURVEY_CUTOFFS)
+
+    def run():
+        policy = get_policy()
+        boxes = binarize_boxes(xH_boxes.astype(policy.field))
+        sorted_halos = sort_n_i_halos(halo_coords, halo_masses, boxes[0], boxes[1])
+        _, voxel_masses, survey_masses = selection.sparse_fields(flat_inds, halo_masses.astype(policy.mass),
+                                                                 selection.levels(mags), dtype=policy.field)
+        return boxes, sorted_halos, voxel_masses, survey_masses
+
+    previous = set_policy('float64')
+    try:
+        ref = run()
+        set_policy(name or previous.name)
+        out = run()
+    finally:
+        set_policy(previous.name)
+
+    max_rel = 0.
+    def close(a, b, what):
+        nonlocal max_rel
+        a, b = np.sum(a, dtype=np.float64), np.sum(b, dtype=np.float64)
+        rel = abs(a - b) / max(abs(b), np.finfo(np.float64).tiny)
+        max_rel = max(max_rel, rel)
+        assert rel <= rtol, f"{what}: {a} vs float64 {b} (relative difference {rel:.2e})"
+
+    assert np.array_equal(out[0].astype(bool), ref[0].astype(bool)), "binarized boxes differ"
+    for k, v in ref[1].items():
+        assert len(out[1][k]) == len(v), f"{k}: halo counts differ"
+        if k.endswith('coords'):
+            assert np.array_equal(out[1][k].astype(np.int64), v.astype(np.int64)), f"{k} differ"
+        else:
+            close(out[1][k], v, k)
+    close(out[2], ref[2], 'halo_mass_field')
+    for k, v in ref[3].items():
+        assert np.count_nonzero(out[3][k]) == np.count_nonzero(v), f"{k}: galaxy counts differ"
+        close(out[3][k], v, k)
+
+    return max_rel
+
+if __name__ == '__main__':
+
+    name = sys.argv[1] if len(sys.argv) > 1 else get_policy().name
+    max_rel = check_policy(name)
+    print(f"\n ====== {name} policy matches the float64 path, max. relative difference {max_rel:.2e} ====== \n")
@@ -0,0 +1,206 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Persistent, content-addressed cache of 21cmFAST halo lists. Halo lists are
+keyed by a hash of (UserParams, random_seed, redshift) and stored as small
+compressed .h5 files on local disk, so repeated analyses (e.g. changing survey
+cutoffs) skip the initial conditions and the halo finder entirely. The cache
+is bounded in size, evicting the least recently used halo lists first.
+
+For redshift-parallel runs, share_init_boxes writes the initial conditions to
+a file once and attach_init_boxes reads them back in each worker, both through
+the public py21cmfast OutputStruct I/O.
+
+'''
+
+import os
+import json
+import h5py
+import hashlib
+import numpy as np
+from cache_index import z_key
+
+DEFAULT_CACHE_DIR = os.environ.get('HALO_CACHE_DIR',
+                                   os.path.expanduser('~/.cache/galaxy-mapping/halos'))
+
+# UserParams that change performance but not the halo list
+NON_DEFINING_PARAMS = ('N_THREADS',)
+
+def params_to_dict(user_params):
+
+    '''Function to return a plain dict of the defining 21cmFAST UserParams.'''
+
+    if hasattr(user_params, 'defining_dict'):
+        params = dict(user_params.defining_dict)
+    else:
+        params = dict(user_params)
+
+    return {k: v for k, v in params.items() if k not in NON_DEFINING_PARAMS}
+
+def share_init_boxes(init_boxes, share_dir):
+
+    '''
+    Function to write a 21cmFAST InitialConditions to share_dir once, with the
+    public OutputStruct.write, so that worker processes can read it back
+    instead of receiving pickled copies. Returns the file name for
+    attach_init_boxes.
+    '''
+
+    os.makedirs(share_dir, exist_ok=True)
+    fname = os.path.join(share_dir, 'init_boxes.h5')
+    init_boxes.write(direc=share_dir, fname=fname)
+
+    return fname
+
+def attach_init_boxes(fname):
+
+    '''
+    Function to read the InitialConditions written by share_init_boxes in a
+    worker, with the public InitialConditions.from_file. Each worker holds its
+    own copy of the boxes.
+    '''
+
+    import py21cmfast as p21c
+
+    return p21c.InitialConditions.from_file(fname)
+
+class HaloCache:
+
+    """
+    Size-bounded LRU cache of halo lists on local disk.
+    ----------
+    Attributes
+    :cache_dir: (str) Directory holding the cached halo lists.
+    :max_bytes: (int) Cache size above which least recently used entries
+                      are evicted.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = 20 * 1024**3):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._init_boxes = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, user_params, random_seed: int, redshift: float) -> str:
+        """
+        Returns the content hash of (user_params, random_seed, redshift). The
+        redshift is rounded to float32 (cache_index.z_key), so float32 redshifts
+        (e.g. from DataManager) and float64 ones read from h5 share entries.
+        """
+
+        inputs = {'user_params': params_to_dict(user_params),
+                  'random_seed': int(random_seed),
+                  'redshift': z_key(redshift)}
+        encoded = json.dumps(inputs, sort_keys=True, default=str).encode()
+
+        return hashlib.sha1(encoded).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.h5")
+
+    def get(self, user_params, random_seed: int, redshift: float):
+        """Returns the cached halo list as a dict, or None on a miss"""
+
+        fname = self.path(self.key(user_params, random_seed, redshift))
+
+        try:
+            with h5py.File(fname, 'r') as hf:
+                halos = {'halo_coords': hf['halo_coords'][:].astype(np.int32),
+                         'halo_masses': hf['halo_masses'][:],
+                         'mass_bins': hf['mass_bins'][:]}
+        except (OSError, KeyError):
+            return None
+
+        # Mark as recently used (another process may have just evicted it)
+        try:
+            os.utime(fname)
+        except FileNotFoundError:
+            pass
+
+        return halos
+
+    def put(self, user_params, random_seed: int, redshift: float,
+            halo_coords, halo_masses, mass_bins):
+        """Stores a halo list in the cache and returns it as a dict"""
+
+        fname = self.path(self.key(user_params, random_seed, redshift))
+        halo_coords = np.asarray(halo_coords)
+
+        # Coordinates are non-negative grid indices, uint16 covers DIM < 65536
+        coords_dtype = np.uint16 if halo_coords.size == 0 or halo_coords.max() < 2**16 else np.int32
+
+        tmp_name = fname + '.tmp'
+        with h5py.File(tmp_name, 'w') as hf:
+            hf.create_dataset('halo_coords', data=halo_coords.astype(coords_dtype),
+                              compression='lzf', shuffle=True)
+            hf.create_dataset('halo_masses', data=halo_masses,
+                              compression='lzf', shuffle=True)
+            hf.create_dataset('mass_bins', data=mass_bins)
+            hf.attrs['random_seed'] = int(random_seed)
+            hf.attrs['redshift'] = z_key(redshift)
+            hf.attrs['user_params'] = json.dumps(params_to_dict(user_params), default=str)
+        os.replace(tmp_name, fname)
+
+        self.evict()
+
+        return {'halo_coords': halo_coords,
+                'halo_masses': np.asarray(halo_masses),
+                'mass_bins': np.asarray(mass_bins)}
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes"""
+
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith('.h5'):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, fname))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fname))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, fname))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def determine_halo_list(self, redshift: float, user_params, random_seed: int,
+                            init_boxes=None):
+        """
+        Cached equivalent of p21c.determine_halo_list. On a miss the initial
+        conditions (unless given) and the halo list are computed with 21cmFAST
+        and stored. Returns a dict with halo_coords, halo_masses and mass_bins.
+        """
+
+        halos = self.get(user_params, random_seed, redshift)
+        if halos is not None:
+            return halos
+
+        import py21cmfast as p21c
+
+        if init_boxes is None:
+            # Reuse initial conditions across redshifts of the same seed
+            ic_key = self.key(user_params, random_seed, -1)
+            if ic_key not in self._init_boxes:
+                self._init_boxes = {ic_key: p21c.initial_conditions(user_params=user_params,
+                                                                    random_seed=random_seed)}
+            init_boxes = self._init_boxes[ic_key]
+
+        halo_field = p21c.determine_halo_list(redshift=redshift,
+                                              init_boxes=init_boxes,
+                                              user_params=user_params)
+
+        return self.put(user_params, random_seed, redshift, halo_field.halo_coords,
+                        halo_field.halo_masses, halo_field.mass_bins)
@@ -0,0 +1,149 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Consolidated, columnar catalog of sorted halos across all random seeds and
+redshifts of a run. Each halo is stored once as a row of the columns
+
+    coords (uint16, low-res), mass (float32), gt_label, pred_label (bool,
+    True = neutral), seed (int64), redshift (float32)
+
+and an offsets table gives the (start, count) rows of every (seed, redshift)
+block, so a block is sliced in O(1). The catalog can be appended to, read in
+bulk, or packed into a contiguous copy whose columns are memory-mapped.
+
+'''
+
+import os
+import h5py
+import numpy as np
+
+COLUMNS = {'coords': (np.uint16, (3,)),
+           'mass': (np.float32, ()),
+           'gt_label': (np.bool_, ()),
+           'pred_label': (np.bool_, ()),
+           'seed': (np.int64, ()),
+           'redshift': (np.float32, ())}
+
+OFFSET_COLUMNS = {'seed': np.int64, 'redshift': np.float32,
+                  'start': np.int64, 'count': np.int64}
+
+def block_key(seed, redshift):
+
+    '''Function to return the offsets table key of a (seed, redshift) block.'''
+
+    return (int(seed), float(np.float32(redshift)))
+
+class HaloCatalog:
+
+    """
+    Appendable columnar halo catalog stored in a single h5py file.
+    ----------
+    Attributes
+    :filename: (str) Path of the catalog .h5 file.
+    :offsets:  (dict) (seed, redshift) -> (start, count) rows of each block.
+    """
+
+    def __init__(self, filename: str, mode: str = 'a', chunk_rows: int = 2**16):
+
+        self.filename = filename
+        self.hf = h5py.File(filename, mode)
+        self.offsets = {}
+
+        if 'mass' not in self.hf and mode != 'r':
+            for k, (dtype, shape) in COLUMNS.items():
+                self.hf.create_dataset(k, shape=(0,) + shape, maxshape=(None,) + shape,
+                                       chunks=(chunk_rows,) + shape, dtype=dtype,
+                                       compression='lzf')
+            grp = self.hf.create_group('offsets')
+            for k, dtype in OFFSET_COLUMNS.items():
+                grp.create_dataset(k, shape=(0,), maxshape=(None,), chunks=(1024,), dtype=dtype)
+
+        if 'offsets' in self.hf:
+            grp = self.hf['offsets']
+            for seed, z, start, count in zip(grp['seed'][:], grp['redshift'][:],
+                                             grp['start'][:], grp['count'][:]):
+                self.offsets[block_key(seed, z)] = (int(start), int(count))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.hf['mass'].shape[0]
+
+    def __contains__(self, seed_redshift):
+        return block_key(*seed_redshift) in self.offsets
+
+    def close(self):
+        self.hf.close()
+
+    def append(self, seed: int, redshift: float, coords, mass, gt_label, pred_label):
+        """Appends the halos of one (seed, redshift) block"""
+
+        key = block_key(seed, redshift)
+        if key in self.offsets:
+            raise ValueError(f"(seed, redshift) = {key} already in {self.filename}.")
+
+        start = len(self)
+        count = len(mass)
+        rows = {'coords': coords, 'mass': mass, 'gt_label': gt_label,
+                'pred_label': pred_label, 'seed': np.full(count, seed),
+                'redshift': np.full(count, redshift)}
+
+        for k, v in rows.items():
+            dset = self.hf[k]
+            dset.resize(start + count, axis=0)
+            dset[start:] = np.asarray(v).astype(COLUMNS[k][0], copy=False)
+
+        grp = self.hf['offsets']
+        n = grp['start'].shape[0]
+        for k, v in zip(OFFSET_COLUMNS, (seed, redshift, start, count)):
+            grp[k].resize(n + 1, axis=0)
+            grp[k][n] = v
+
+        self.offsets[key] = (start, count)
+
+    def get(self, seed: int, redshift: float, columns=None):
+        """Returns a dict of the columns of one (seed, redshift) block"""
+
+        start, count = self.offsets[block_key(seed, redshift)]
+
+        return {k: self.hf[k][start:start+count] for k in (columns or COLUMNS)}
+
+    def read(self, columns=None):
+        """Returns a dict of whole columns read into memory"""
+
+        return {k: self.hf[k][:] for k in (columns or COLUMNS)}
+
+    def memmap(self, column: str):
+        """
+        Returns a read-only np.memmap of a column. Only possible for packed
+        (contiguous, uncompressed) catalogs, see pack().
+        """
+
+        dset = self.hf[column]
+        offset = dset.id.get_offset()
+        if dset.chunks is not None or offset is None:
+            raise ValueError(f"{column} is chunked, pack() the catalog to memory-map it.")
+
+        return np.memmap(self.filename, mode='r', dtype=dset.dtype,
+                         shape=dset.shape, offset=offset)
+
+    def pack(self, filename: str):
+        """Writes a contiguous, uncompressed copy of the catalog that can be memory-mapped"""
+
+        tmp_name = filename + '.tmp'
+        with h5py.File(tmp_name, 'w') as hf:
+            for k in COLUMNS:
+                hf.create_dataset(k, data=self.hf[k][:])
+            grp = hf.create_group('offsets')
+            for k in OFFSET_COLUMNS:
+                grp.create_dataset(k, data=self.hf['offsets'][k][:])
+        os.replace(tmp_name, filename)
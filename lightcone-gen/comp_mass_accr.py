@@ -10,66 +10,185 @@ Python code to compare the number of galaxies identified above
 survey threshold in the "interpolated" mass accretion halo mass fields
 and the actual halo field obtained by running the 21cmFAST halo finder.
 
+Every interp_galaxy_cutoffs_* file in the data directory (single-redshift
+files, and each redshift group of *_batch.h5 files) is paired with the
+galaxy_cutoffs_* file of the same HII_DIM, DIM, BOX_LEN, redshift and random
+seed. Pairs are compared in parallel by a pool of worker processes, with
+chunked sums and counts read directly from the files, and the results of the
+whole sweep are written to one summary table. Bar plots are optional
+(--plot) and made from the table afterwards.
+
 '''
 
-import h5py
+import os
+import re
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-
-# Load in halo mass fields
-interp_z = 7.997138310109906
-fname_true = '/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/galaxy_cutoffs_HII_DIM_128_DIM_384_BOXLEN_128_z_7.997138310109906_rseed_42142.h5'
-fname_interp = '/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/interp_galaxy_cutoffs_HII_DIM_128_DIM_384_BOXLEN_128_z_7.997138310109906_rseed_42142.h5'
-hf_truth = h5py.File(fname_true, 'r')
-hf_interp = h5py.File(fname_interp, 'r')
-
-halo_mass_field_true = np.array(hf_truth['halo_mass_field'])
-JWST_UD_gals_true = np.array(hf_truth['JWST_UD_gals'])
-JWST_MD_gals_true = np.array(hf_truth['JWST_MD_gals'])
-JWST_WF_gals_true = np.array(hf_truth['JWST_WF_gals'])
-Roman_gals_true = np.array(hf_truth['Roman_gals'])
-
-halo_mass_field_interp = np.array(hf_interp['inter_halo_mass_field'])
-JWST_UD_gals_interp = np.array(hf_interp['JWST_UD_gals'])
-JWST_MD_gals_interp = np.array(hf_interp['JWST_MD_gals'])
-JWST_WF_gals_interp = np.array(hf_interp['JWST_WF_gals'])
-Roman_gals_interp= np.array(hf_interp['Roman_gals'])
-
-mass_diff = np.sum(halo_mass_field_true) - np.sum(halo_mass_field_interp)
-print(f"\n ====== The total halo mass difference (true - interp) is: {mass_diff/1e10} 10^10 M_sol ====== \n")
-
-
-# Compute number of galaxies above each survey magnitude threshold
-num_JWST_UD_gals_true = len(JWST_UD_gals_true[JWST_UD_gals_true > 0])
-num_JWST_MD_gals_true = len(JWST_MD_gals_true[JWST_MD_gals_true > 0])
-num_JWST_WF_gals_true = len(JWST_WF_gals_true[JWST_WF_gals_true > 0])
-num_Roman_gals_true = len(Roman_gals_true[Roman_gals_true > 0])
-
-num_JWST_UD_gals_interp = len(JWST_UD_gals_interp[JWST_UD_gals_interp > 0])
-num_JWST_MD_gals_interp = len(JWST_MD_gals_interp[JWST_MD_gals_interp > 0])
-num_JWST_WF_gals_interp = len(JWST_WF_gals_interp[JWST_WF_gals_interp > 0])
-num_Roman_gals_interp = len(Roman_gals_interp[Roman_gals_interp > 0])
-
-# Make a bar graph with number of galaxies above threshold for true and interp halo mass fields
-labels = ['JWST-UD', 'JWST-MD', 'JWST-WF', 'Roman']
-true_gal_counts = [num_JWST_UD_gals_true, num_JWST_MD_gals_true, num_JWST_WF_gals_true, num_Roman_gals_true]
-interp_gal_counts = [num_JWST_UD_gals_interp, num_JWST_MD_gals_interp, num_JWST_WF_gals_interp, num_Roman_gals_interp]
-
-x = np.arange(len(labels))  # the label locations
-width = 0.35  # the width of the bars
-
-fig, ax = plt.subplots()
-rects1 = ax.bar(x - width/2, true_gal_counts, width, label='True')
-rects2 = ax.bar(x + width/2, interp_gal_counts, width, label='Interp')
-
-# Add some text for labels, title and custom x-axis tick labels, etc.
-plt.ylabel(r'$m_{AB, gal} > m_{AB, survey}$')
-plt.xticks(x, labels)
-plt.yscale('log')
-plt.legend()
-
-plt.bar_label(rects1, padding=3)
-plt.bar_label(rects2, padding=3)
-
-fig.tight_layout()
-plt.savefig(f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/compare_interp_@_z_{interp_z}.jpeg')
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utility_funcs import survey_field_name
+from sparse_fields import SparseFields
+from survey_selection import SURVEY_CUTOFFS
+
+data_dir = '/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/'
+
+PARAMS = r'HII_DIM_(\d+)_DIM_(\d+)_BOXLEN_(\d+)'
+TRUE_PATTERN = re.compile(rf'galaxy_cutoffs_{PARAMS}_z_(.+)_rseed_(\d+)\.h5$')
+INTERP_PATTERN = re.compile(rf'interp_galaxy_cutoffs_{PARAMS}_z_(.+)_rseed_(\d+)\.h5$')
+BATCH_PATTERN = re.compile(rf'interp_galaxy_cutoffs_{PARAMS}_from_z_(.+)_rseed_(\d+)_batch\.h5$')
+
+def pair_key(HII_DIM, DIM, BOX_LEN, redshift, rseed):
+
+    '''Function to return the key matching true and interpolated fields.'''
+
+    return (int(HII_DIM), int(DIM), int(BOX_LEN), float(np.float32(redshift)), int(rseed))
+
+def find_pairs(data_dir):
+
+    '''
+    Function to pair every interpolated field in data_dir with its true field.
+    Returns a sorted list of (key, fname_true, fname_interp, group), group being
+    None for single-redshift interpolated files.
+    '''
+
+    true_files = {}
+    for fname in glob(os.path.join(data_dir, 'galaxy_cutoffs_*.h5')):
+        match = TRUE_PATTERN.match(os.path.basename(fname))
+        if match:
+            true_files[pair_key(*match.groups())] = fname
+
+    interp_fields = []
+    for fname in glob(os.path.join(data_dir, 'interp_galaxy_cutoffs_*.h5')):
+        basename = os.path.basename(fname)
+        match = INTERP_PATTERN.match(basename)
+        if match:
+            interp_fields.append((pair_key(*match.groups()), fname, None))
+            continue
+        match = BATCH_PATTERN.match(basename)
+        if match:
+            HII_DIM, DIM, BOX_LEN, _, rseed = match.groups()
+            with SparseFields(fname) as fields:
+                groups = [(k, fields.hf[k].attrs['redshift']) for k in fields.hf if k.startswith('z_')]
+            for group, redshift in groups:
+                interp_fields.append((pair_key(HII_DIM, DIM, BOX_LEN, redshift, rseed), fname, group))
+
+    pairs = [(key, true_files[key], fname, group) for key, fname, group in interp_fields if key in true_files]
+
+    return sorted(pairs, key=lambda pair: pair[0])
+
+def compare_pair(fname_true, fname_interp, group, surveys):
+
+    '''
+    Worker comparing one true / interpolated pair. Sums and counts are
+    computed chunk by chunk on the (sparse or dense) files, without building
+    dense boxes. Counts of surveys missing from a file are -1.
+    '''
+
+    with SparseFields(fname_true) as fields_true, SparseFields(fname_interp, group=group) as fields_interp:
+
+        mass_true = fields_true.sum('halo_mass_field')
+        mass_interp = fields_interp.sum('inter_halo_mass_field')
+
+        # Compute number of galaxies above each survey magnitude threshold
+        counts = {}
+        for survey in surveys:
+            name = survey_field_name(survey)
+            counts[survey] = tuple(fields.count_nonzero(name) if name in fields else -1
+                                   for fields in (fields_true, fields_interp))
+
+    return mass_true, mass_interp, counts
+
+def write_summary(fname, rows, surveys):
+
+    '''Function to write the sweep summary as a .csv table.'''
+
+    header = ['HII_DIM', 'DIM', 'BOX_LEN', 'redshift', 'rseed', 'mass_true', 'mass_interp', 'mass_diff']
+    for survey in surveys:
+        header += [f'n_true_{survey}', f'n_interp_{survey}']
+    header += ['fname_interp', 'group']
+
+    tmp_name = fname + '.tmp'
+    with open(tmp_name, 'w') as f:
+        f.write(','.join(header) + '\n')
+        for row in rows:
+            f.write(','.join(str(v) for v in row) + '\n')
+    os.replace(tmp_name, fname)
+
+def plot_counts(redshift, surveys, true_gal_counts, interp_gal_counts, fname_plot):
+
+    '''
+    Function to make a bar graph with the number of galaxies above threshold
+    for the true and interp halo mass fields.
+    '''
+
+    import matplotlib.pyplot as plt
+
+    x = np.arange(len(surveys))  # the label locations
+    width = 0.35  # the width of the bars
+
+    fig, ax = plt.subplots()
+    rects1 = ax.bar(x - width/2, true_gal_counts, width, label='True')
+    rects2 = ax.bar(x + width/2, interp_gal_counts, width, label='Interp')
+
+    # Add some text for labels, title and custom x-axis tick labels, etc.
+    ax.set_ylabel(r'$m_{AB, gal} > m_{AB, survey}$')
+    ax.set_title(f'z = {redshift}')
+    ax.set_xticks(x, surveys)
+    ax.set_yscale('log')
+    ax.legend()
+
+    ax.bar_label(rects1, padding=3)
+    ax.bar_label(rects2, padding=3)
+
+    fig.tight_layout()
+    fig.savefig(fname_plot)
+    plt.close(fig)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare true and interpolated galaxy fields over a whole sweep.')
+    parser.add_argument('--data_dir', default=data_dir, help='Directory of the galaxy_cutoffs_* files.')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='Number of worker processes (default: cpu_count).')
+    parser.add_argument('--summary', default=None,
+                        help='Summary table (default: data_dir/compare_interp_summary.csv).')
+    parser.add_argument('--plot', action='store_true', help='Also save a bar graph per pair.')
+    args = parser.parse_args()
+
+    surveys = list(SURVEY_CUTOFFS)
+    pairs = find_pairs(args.data_dir)
+    print(f"\n ====== Comparing {len(pairs)} true / interp field pairs ====== \n")
+
+    rows = {}
+    with ProcessPoolExecutor(max_workers=args.num_workers) as pool:
+
+        futures = {pool.submit(compare_pair, fname_true, fname_interp, group, surveys): (key, fname_interp, group)
+                   for key, fname_true, fname_interp, group in pairs}
+
+        for future in as_completed(futures):
+            key, fname_interp, group = futures[future]
+            try:
+                mass_true, mass_interp, counts = future.result()
+            except Exception as e:
+                print(f"\n ====== {os.path.basename(fname_interp)} {group or ''} failed: {e!r} ====== \n")
+                continue
+            row = list(key) + [mass_true, mass_interp, mass_true - mass_interp]
+            for survey in surveys:
+                row += list(counts[survey])
+            rows[(key, fname_interp, group)] = row + [os.path.basename(fname_interp), group or '']
+
+            print(f"\n ====== z = {key[3]}, rseed = {key[4]}: total halo mass difference (true - interp) is: "
+                  f"{(mass_true - mass_interp)/1e10} 10^10 M_sol ====== \n")
+
+    rows = [rows[k] for k in sorted(rows, key=lambda k: (k[0], k[1], k[2] or ''))]
+    fname_summary = args.summary or os.path.join(args.data_dir, 'compare_interp_summary.csv')
+    write_summary(fname_summary, rows, surveys)
+    print(f'\n ====== File {fname_summary} saved ====== \n')
+
+    if args.plot:
+        for row in rows:
+            redshift, rseed, group = row[3], row[4], row[-1]
+            true_gal_counts = row[8:8 + 2*len(surveys):2]
+            interp_gal_counts = row[9:9 + 2*len(surveys):2]
+            plot_counts(redshift, surveys, true_gal_counts, interp_gal_counts,
+                        os.path.join(args.data_dir, f"compare_interp_@_z_{redshift}_rseed_{rseed}{'_' + group if group else ''}.jpeg"))
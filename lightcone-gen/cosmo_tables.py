@@ -0,0 +1,144 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Python code for tabulated cosmology lookups. A dense, monotone
+comoving-distance table is integrated once per cosmology on a grid uniform in
+log(1+z), refined until linear interpolation is accurate to a stated redshift
+tolerance, and cached on disk keyed by (H0, Om0, Tcmb0) and the table
+columns. Whole arrays of
+comoving distances are then inverted to redshifts by interpolation instead of
+one astropy z_at_value root solve per distance.
+
+The luminosity distance and cosmic age are served from the same grid as plain
+float arrays, so a CosmoTable can be passed to get_mag_app and calc_mass_accr
+in place of an astropy cosmology.
+
+'''
+
+import os
+import numpy as np
+from astropy.cosmology import FlatLambdaCDM
+from table_cache import (table_cache_key, load_tables)
+
+TABLE_KEYS = ('z', 'comoving_dist', 'cosmic_age', 'tolerance')
+
+DEFAULT_CACHE_DIR = os.environ.get('COSMO_CACHE_DIR',
+                                   os.path.expanduser('~/.cache/galaxy-mapping/cosmo'))
+
+class CosmoTable:
+
+    """
+    Tabulated flat LambdaCDM cosmology.
+    ----------
+    Attributes
+    :H0:        (float) Hubble constant [km/s/Mpc].
+    :Om0:       (float) Matter density today.
+    :Tcmb0:     (float) CMB temperature today [K].
+    :z_max:     (float) Largest tabulated redshift.
+    :tolerance: (float) Achieved max. redshift error of the distance inversion.
+    :z:         (array) Redshift grid.
+    :comoving_dist: (array) Comoving distance [Mpc] on the grid.
+    :cosmic_age: (array) Age of the universe [Gyr] on the grid.
+    """
+
+    def __init__(self, H0: float = 67.32, Om0: float = 0.3158, Tcmb0: float = 2.725,
+                 z_max: float = 30., tolerance: float = 1e-6,
+                 cache_dir: str = DEFAULT_CACHE_DIR):
+
+        self.H0 = float(H0)
+        self.Om0 = float(Om0)
+        self.Tcmb0 = float(Tcmb0)
+        self.z_max = float(z_max)
+        self.cosmo = FlatLambdaCDM(H0=self.H0, Om0=self.Om0, Tcmb0=self.Tcmb0)
+
+        key = table_cache_key((TABLE_KEYS, self.H0, self.Om0, self.Tcmb0, self.z_max, tolerance))
+        fname = os.path.join(cache_dir, f'cosmo_table_{key}.npz') if cache_dir else None
+
+        self._set_tables(load_tables(fname, lambda: self.build_tables(tolerance)))
+
+    def _set_tables(self, tables):
+        self.tables = {k: np.asarray(v) for k, v in tables.items()}
+        self.z = self.tables['z']
+        self.comoving_dist = self.tables['comoving_dist']
+        self.cosmic_age = self.tables['cosmic_age']
+        self._u = np.log1p(self.z)
+        self.tolerance = float(self.tables['tolerance'])
+
+    def _integrate(self, num):
+        """
+        Comoving distance [Mpc] and cosmic age [Gyr] on a grid of num points
+        uniform in u = log(1+z), integrating (1+z)/E(z) du and 1/E(z) du
+        cumulatively with the trapezoidal rule. The age is anchored to the
+        astropy age at z_max.
+        """
+
+        u = np.linspace(0, np.log1p(self.z_max), num)
+        z = np.expm1(u)
+        inv_efunc = self.cosmo.inv_efunc(z)
+
+        integrand = (1 + z) * inv_efunc
+        steps = 0.5 * (integrand[1:] + integrand[:-1]) * np.diff(u)
+        dist = self.cosmo.hubble_distance.value * np.concatenate(([0.], np.cumsum(steps)))
+
+        steps = 0.5 * (inv_efunc[1:] + inv_efunc[:-1]) * np.diff(u)
+        age_after_z_max = np.concatenate((np.cumsum(steps[::-1])[::-1], [0.]))
+        age = self.cosmo.age(self.z_max).to_value('Gyr') + self.cosmo.hubble_time.to_value('Gyr') * age_after_z_max
+
+        return z, dist, age
+
+    def build_tables(self, tolerance):
+        """
+        Tabulates the comoving distance, doubling the grid until inverting at
+        the midpoints of the table is accurate to tolerance in redshift.
+        """
+
+        num = 1024
+        while True:
+            # Odd points of the 2x finer grid are the midpoints of the table
+            z_fine, dist_fine, age_fine = self._integrate(2 * num - 1)
+            z, dist, age = z_fine[::2], dist_fine[::2], age_fine[::2]
+            err = np.max(np.abs(np.interp(dist_fine[1::2], dist, z) - z_fine[1::2]))
+            if err <= tolerance or num >= 2**22:
+                break
+            num *= 2
+
+        return {'z': z, 'comoving_dist': dist, 'cosmic_age': age, 'tolerance': err}
+
+    def _check_z(self, z):
+        z = np.asarray(z, dtype=np.float64)
+        if np.any(z < 0) or np.any(z > self.z_max):
+            raise ValueError(f"Redshifts must lie in [0, {self.z_max}], increase z_max.")
+        return z
+
+    def comoving_distance(self, z):
+        """Vectorized comoving distance [Mpc] at redshifts z"""
+
+        return np.interp(np.log1p(self._check_z(z)), self._u, self.comoving_dist)
+
+    def luminosity_distance(self, z):
+        """Vectorized luminosity distance [Mpc] at redshifts z (flat universe)"""
+
+        z = self._check_z(z)
+        return (1 + z) * np.interp(np.log1p(z), self._u, self.comoving_dist)
+
+    def age(self, z):
+        """Vectorized age of the universe [Gyr] at redshifts z"""
+
+        return np.interp(np.log1p(self._check_z(z)), self._u, self.cosmic_age)
+
+    def z_at_comoving_distance(self, dist):
+        """
+        Vectorized inverse of the comoving distance: redshifts of dist [Mpc].
+        """
+
+        dist = np.asarray(dist, dtype=np.float64)
+        if np.any(dist < 0) or np.any(dist > self.comoving_dist[-1]):
+            raise ValueError(f"Comoving distances must lie in [0, {self.comoving_dist[-1]:.1f}] Mpc, "
+                             f"increase z_max.")
+
+        return np.interp(dist, self.comoving_dist, self.z)
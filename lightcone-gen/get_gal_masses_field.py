@@ -8,17 +8,44 @@ Description:
 
 Python code to generate a field of halo masses representing galaxies 
 above the apparent magnitude thresholds of surveys. Halo mass fields are
-saved to a .h5 file.
+saved to a .h5 file in the sparse format of sparse_fields.py.
+
+With --num_workers > 1, redshifts are processed concurrently by a pool of
+worker processes. The initial conditions are computed once, written to a
+file (halo_cache.share_init_boxes) and read back by each worker, so they are
+never pickled nor recomputed per redshift.
 
 '''
 
+import os
+import sys
+import argparse
+
+# Limit threads per worker before numpy/21cmFAST are imported
+parser = argparse.ArgumentParser(description='Generate galaxy fields above survey thresholds at each redshift.')
+parser.add_argument('--num_workers', type=int, default=1,
+                    help='Number of worker processes processing redshifts concurrently (default: 1, serial).')
+parser.add_argument('--threads_per_worker', type=int, default=1,
+                    help='OpenMP threads used by each worker.')
+args, _ = parser.parse_known_args()
+if args.num_workers > 1:
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(args.threads_per_worker)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 import h5py
+import tempfile
 import numpy as np
 import py21cmfast as p21c
-import astropy.units as u
 import matplotlib.pyplot as plt
-from utility_funcs import (L_to_MAB, get_mag_app)
-from astropy.cosmology import FlatLambdaCDM
+from utility_funcs import (L_to_MAB, get_mag_app, survey_field_name)
+from survey_selection import (SurveySelection, SURVEY_CUTOFFS)
+from sparse_fields import save_sparse_fields
+from cosmo_tables import CosmoTable
+from luminosity_relation import get_luminosity_relation
+from halo_cache import (HaloCache, share_init_boxes, attach_init_boxes)
+from dtype_policy import get_policy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 print(f"\n ============= Using 21cmFAST version {p21c.__version__} ============== \n")
 
@@ -36,111 +63,132 @@ rseed=42142
 gen_field = False # generate ionization fields with halo fields at each z
 
 
-# Specify initial params, generate initial conditions of coeval box
+# Specify initial params of coeval box
 user_params = p21c.UserParams(BOX_LEN=BOX_LEN,
                               HII_DIM=HII_DIM,
                               DIM=DIM,
                               USE_INTERPOLATION_TABLES=True)
 
-init_cond = p21c.initial_conditions(user_params=user_params,
-                                    random_seed=rseed)
+# Halo lists are looked up in the shared halo cache before running 21cmFAST
+halo_cache = HaloCache()
+
+# Generate cosmological model (tabulated once, cached on disk)
+cosmo = CosmoTable(H0=67.32, Om0=0.3158, Tcmb0=2.725)
 
-# Generate cosmological model
-cosmo = FlatLambdaCDM(H0=67.32 * u.km / u.s / u.Mpc, Tcmb0=2.725 * u.K, Om0=0.3158)
+# Galaxy luminosity-halo mass relation, L_1600(Mh, z) (parsed once, cached on disk)
+lum_rel = get_luminosity_relation()
 
-# Load in galaxy luminosity-halo mass relation data, parse data
-Mh_ML_dat = np.loadtxt('/Users/kennedyj/PHYS_459/L1600_vs_Mh_and_z.dat').T
-Mh, L_1600_z6, L_1600_z7, L_1600_z8, L_1600_z9, L_1600_z10 = Mh_ML_dat
+# Define apparent magnitude cutoffs of surveys (any number of entries, e.g.
+# survey_selection.magnitude_grid(26, 33, 0.25) for hypothetical depths)
+cutoffs = SURVEY_CUTOFFS
+selection = SurveySelection(cutoffs)
 
-# Define apparent magnitude cutoffs of surveys
-cutoffs = {'JWST-UD': 32, 'JWST-MD': 30.6, 'JWST-WF': 29.3, 'Roman': 26.5}
+def galaxy_fields_at(redshift, init_boxes=None):
 
-# Loop through redshifts, generate halo fields and check if above thresholds
-for redshift in redshifts:
+    '''
+    Function to generate the halo field at redshift, apply the survey magnitude
+    cutoffs and save the galaxy fields to their own file. init_boxes are the
+    initial conditions, computed (or read from the 21cmFAST cache) if None and
+    needed.
+    '''
 
-    halo_field = p21c.determine_halo_list(redshift=redshift,
-                                          init_boxes=init_cond,
-                                          user_params=user_params)
+    halo_field = halo_cache.determine_halo_list(redshift=redshift,
+                                                user_params=user_params,
+                                                random_seed=rseed,
+                                                init_boxes=init_boxes)
             
-    halo_coords = halo_field.halo_coords // int(DIM//HII_DIM) # DIM//HII_DIM gives scale
-    halo_masses = halo_field.halo_masses
-    halo_mass_bins = halo_field.mass_bins
+    halo_coords = halo_field['halo_coords'] // int(DIM//HII_DIM) # DIM//HII_DIM gives scale
+    halo_masses = halo_field['halo_masses']
+    halo_mass_bins = halo_field['mass_bins']
 
     print(f"\n ====== Num Halos @ {redshift}: {len(halo_coords)} ====== \n")
 
     if gen_field:
 
+        if init_boxes is None:
+            init_boxes = p21c.initial_conditions(user_params=user_params,
+                                                 random_seed=rseed)
+
         perturbed_field = p21c.perturb_field(redshift=redshift,
-                                             init_boxes=init_cond)
+                                             init_boxes=init_boxes)
 
         ionized_field = p21c.ionize_box(perturbed_field=perturbed_field)
                    
         xH_box = ionized_field.xH_box
 
     # Convert halo masses to luminosities
-    Lumo = np.interp(halo_masses, xp = Mh, fp = L_1600_z8)
+    Lumo = lum_rel(redshift, halo_masses)
     MAB = L_to_MAB(Lumo)
     mAB = get_mag_app(redshift, MAB, cosmo)
 
-    # Apply magnitude cutoff for surveys, get halo fields
-    halo_mass_field = np.zeros(shape=(HII_DIM,HII_DIM,HII_DIM)) # to be used for mass accretion addition
-    JWST_UD_gals = np.zeros(shape=(HII_DIM,HII_DIM,HII_DIM))
-    JWST_MD_gals = np.zeros(shape=(HII_DIM,HII_DIM,HII_DIM))
-    JWST_WF_gals = np.zeros(shape=(HII_DIM,HII_DIM,HII_DIM))
-    Roman_gals = np.zeros(shape=(HII_DIM,HII_DIM,HII_DIM))
+    # Apply magnitude cutoff for surveys, sum halo masses per occupied voxel in one pass
+    levels = selection.levels(mAB)
+    flat_inds = np.ravel_multi_index(halo_coords.T, (HII_DIM,)*3)
+    voxel_inds, voxel_masses, survey_masses = selection.sparse_fields(flat_inds, halo_masses, levels,
+                                                                      dtype=get_policy().field)
 
-    JWST_UD_gal_coords = halo_coords[mAB<cutoffs['JWST-UD']]
-    JWST_MD_gal_coords = halo_coords[mAB<cutoffs['JWST-MD']]
-    JWST_WF_gal_coords = halo_coords[mAB<cutoffs['JWST-WF']]
-    Roman_gal_coords = halo_coords[mAB<cutoffs['Roman']]
+    print(f"\n ====== Observable galaxies in each survey: {selection.counts(levels)} ====== \n")
 
-    JWST_UD_gal_masses = halo_masses[mAB<cutoffs['JWST-UD']]
-    JWST_MD_gal_masses = halo_masses[mAB<cutoffs['JWST-MD']]
-    JWST_WF_gal_masses = halo_masses[mAB<cutoffs['JWST-WF']]
-    Roman_gal_masses = halo_masses[mAB<cutoffs['Roman']]
+    fname_save = f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/galaxy_cutoffs_HII_DIM_{HII_DIM}_DIM_{DIM}_BOXLEN_{BOX_LEN}_z_{redshift}_rseed_{rseed}.h5'
 
-    for i in range(len(halo_masses)): 
+    # Save occupied voxels once plus per-field masses (sparse_fields.py format)
+    fields = {'halo_mass_field': voxel_masses}
+    fields.update({survey_field_name(survey): v for survey, v in survey_masses.items()})
+    extra = {'halo_mass_bins': halo_mass_bins}
+    if gen_field:
+        extra['xH_box'] = np.asarray(xH_box, dtype=get_policy().field) # dense, for lightcone.py
+    save_sparse_fields(fname_save, voxel_inds, fields, (HII_DIM,)*3, extra=extra)
+    
+    print(f'\n ====== File {fname_save} saved ====== \n')
 
-        if i < len(Roman_gal_coords):
+    return fname_save
 
-            halo_mass_field[tuple(halo_coords[i])] += halo_masses[i]
-            JWST_UD_gals[tuple(JWST_UD_gal_coords[i])] += JWST_UD_gal_masses[i]
-            JWST_MD_gals[tuple(JWST_MD_gal_coords[i])] += JWST_MD_gal_masses[i]
-            JWST_WF_gals[tuple(JWST_WF_gal_coords[i])] += JWST_WF_gal_masses[i]
-            Roman_gals[tuple(Roman_gal_coords[i])] += Roman_gal_masses[i]
+_worker_init_boxes = None
 
-        elif i < len(JWST_WF_gal_coords):
+def _attach_worker(fname_init):
+    '''Pool initializer reading the shared initial conditions once per worker.'''
+    global _worker_init_boxes
+    _worker_init_boxes = attach_init_boxes(fname_init)
 
-            halo_mass_field[tuple(halo_coords[i])] += halo_masses[i]
-            JWST_UD_gals[tuple(JWST_UD_gal_coords[i])] += JWST_UD_gal_masses[i]
-            JWST_MD_gals[tuple(JWST_MD_gal_coords[i])] += JWST_MD_gal_masses[i]
-            JWST_WF_gals[tuple(JWST_WF_gal_coords[i])] += JWST_WF_gal_masses[i]
+def _worker_galaxy_fields_at(redshift):
+    return galaxy_fields_at(redshift, init_boxes=_worker_init_boxes)
 
-        elif i < len(JWST_MD_gal_coords):
+if __name__ == '__main__':
 
-            halo_mass_field[tuple(halo_coords[i])] += halo_masses[i]
-            JWST_UD_gals[tuple(JWST_UD_gal_coords[i])] += JWST_UD_gal_masses[i]
-            JWST_MD_gals[tuple(JWST_MD_gal_coords[i])] += JWST_MD_gal_masses[i]
+    # Initial conditions are only needed for halo lists missing from the cache
+    cached = [os.path.isfile(halo_cache.path(halo_cache.key(user_params, rseed, z))) for z in redshifts]
 
-        elif i < len(JWST_UD_gal_coords):
+    if args.num_workers <= 1 or (all(cached) and not gen_field):
 
-            halo_mass_field[tuple(halo_coords[i])] += halo_masses[i]
-            JWST_UD_gals[tuple(JWST_UD_gal_coords[i])] += JWST_UD_gal_masses[i]
+        # Loop through redshifts, generate halo fields and check if above thresholds
+        for redshift in redshifts:
+            galaxy_fields_at(redshift)
 
-        else:
+    else:
 
-            halo_mass_field[tuple(halo_coords[i])] += halo_masses[i]
+        # Compute initial conditions once and share them with the workers
+        # through a file; redshifts are then processed concurrently, each worker
+        # writing its own galaxy_cutoffs_* files
+        init_cond = p21c.initial_conditions(user_params=user_params,
+                                            random_seed=rseed)
 
-    
-    fname_save = f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/galaxy_cutoffs_HII_DIM_{HII_DIM}_DIM_{DIM}_BOXLEN_{BOX_LEN}_z_{redshift}_rseed_{rseed}.h5'
-    
-    hf2 = h5py.File(fname_save, 'w')
-    hf2.create_dataset('halo_mass_bins', data=halo_mass_bins)
-    hf2.create_dataset('halo_mass_field', data=halo_mass_field)
-    hf2.create_dataset('JWST_UD_gals', data=JWST_UD_gals)
-    hf2.create_dataset('JWST_MD_gals', data=JWST_MD_gals)
-    hf2.create_dataset('JWST_WF_gals', data=JWST_WF_gals)
-    hf2.create_dataset('Roman_gals', data=Roman_gals)
-    hf2.close()
-    
-    print(f'\n ====== File {fname_save} saved ====== \n')
+        with tempfile.TemporaryDirectory(prefix='init_boxes_') as share_dir:
+
+            fname_init = share_init_boxes(init_cond, share_dir)
+            del init_cond
+
+            failed = []
+            with ProcessPoolExecutor(max_workers=args.num_workers, initializer=_attach_worker,
+                                     initargs=(fname_init,)) as pool:
+
+                futures = {pool.submit(_worker_galaxy_fields_at, redshift): redshift for redshift in redshifts}
+
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"\n ====== z = {futures[future]} failed: {e!r} ====== \n")
+                        failed.append(futures[future])
+
+        if failed:
+            sys.exit(f"\n ====== {len(failed)} of {len(redshifts)} redshifts failed: {sorted(failed)} ====== \n")
@@ -8,36 +8,111 @@ Description:
 
 Code to compute the halo mass accreted over a redshift interval, 
 based on the script get_mar.py written by Jordan Mirocha and using
-his ARES package.
+his ARES package. The ares accretion-rate tables are built once and
+cached on disk (MARTable), so later runs do not import ares.
 
 """
 
+import os
 import sys
-sys.path.insert(0, '/Users/kennedyj/PHYS_459/Github/ares')
-import ares
 import numpy as np
 import astropy.units as u
 import matplotlib.pyplot as pl
-from astropy.cosmology import FlatLambdaCDM
+from table_cache import (table_cache_key, load_tables, bilinear_interp)
 
-def calc_mass_accr(z_high, z_low, halomasses, cosmo_mod):
+ARES_PATH = '/Users/kennedyj/PHYS_459/Github/ares'
+DEFAULT_CACHE_DIR = os.environ.get('MAR_CACHE_DIR',
+                                   os.path.expanduser('~/.cache/galaxy-mapping/mar'))
+
+class MARTable:
+
+    """
+    Mass accretion rate table (tab_z, tab_M, tab_MAR) of an ares galaxy
+    population. The table is built with ares once, saved to a local .npz
+    cache and served from there afterwards, so ares is only imported when
+    the cache is cold.
+    ----------
+    Attributes
+    :tab_z:   (array) Redshift grid (increasing).
+    :tab_M:   (array) Halo mass grid [Msun] (increasing).
+    :tab_MAR: (array) Mass accretion rate [Msun / yr], shape (len(tab_z), len(tab_M)).
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, **pop_kwargs):
+
+        key = table_cache_key(sorted(pop_kwargs.items()))
+        tables = load_tables(os.path.join(cache_dir, f'ares_mar_table_{key}.npz'),
+                             lambda: self.build_tables(**pop_kwargs))
+
+        self.tab_z = tables['tab_z']
+        self.tab_M = tables['tab_M']
+        self.tab_MAR = tables['tab_MAR']
+
+    @staticmethod
+    def build_tables(**pop_kwargs):
+        """Initializes the galaxy population in ares and returns its sorted MAR tables"""
+
+        if ARES_PATH not in sys.path:
+            sys.path.insert(0, ARES_PATH)
+        import ares
+
+        pop = ares.populations.GalaxyPopulation(**pop_kwargs)
+        tab_z = np.asarray(pop.halos.tab_z)
+        tab_M = np.asarray(pop.halos.tab_M)
+        tab_MAR = np.asarray(pop.halos.tab_MAR)
+
+        iz, iM = np.argsort(tab_z), np.argsort(tab_M)
+
+        return {'tab_z': tab_z[iz], 'tab_M': tab_M[iM], 'tab_MAR': tab_MAR[iz][:, iM]}
+
+    def __call__(self, z, halomasses):
+        """
+        Vectorized bilinear interpolation of the mass accretion rate [Msun / yr]
+        in (z, M). z and halomasses are broadcast against each other; values
+        outside the tables are clamped to the table edges, as np.interp does.
+        """
+
+        z, M = np.broadcast_arrays(np.asarray(z, dtype=np.float64),
+                                   np.asarray(halomasses, dtype=np.float64))
+
+        return bilinear_interp(self.tab_z, self.tab_M, self.tab_MAR, z, M)
+
+_mar_table = None
+
+def get_mar_table():
     '''
-    Function to compute the halo mass accreted over a specific redshift interval.
+    Function to return the default MARTable, loaded once per process.
     '''
+    global _mar_table
+    if _mar_table is None:
+        _mar_table = MARTable()
+    return _mar_table
 
-    #Initialize galaxy population in ares
-    pop = ares.populations.GalaxyPopulation()
+def calc_delta_t(z_high, z_low, cosmo_mod):
+    '''
+    Function to compute the time elapsed [yr] between z_high and z_low (scalar
+    or array). cosmo_mod is an astropy cosmology or a cosmo_tables.CosmoTable.
+    '''
 
-    # Find redshift in lookup table
-    iz = np.argmin(np.abs(pop.halos.tab_z - z_high))
+    delta_t = cosmo_mod.age(z_low) - cosmo_mod.age(z_high)
+    if isinstance(delta_t, u.Quantity):
+        delta_t = delta_t.to_value(u.Gyr)
+
+    return delta_t * 1e9 # convert to number of years
+
+def calc_mass_accr(z_high, z_low, halomasses, cosmo_mod, mar_table=None):
+    '''
+    Function to compute the halo mass accreted over a specific redshift interval.
+    The mass accretion rate at z_high is looked up in mar_table (the cached
+    default MARTable if None).
+    '''
 
-    # Interpolate in halo mass to get mass accretion rate [Msun / yr]
-    MAR = np.interp(halomasses, pop.halos.tab_M, pop.halos.tab_MAR[iz,:])
-    #print('Mass accretion rate of Mh={:.1e} Msun at z={:.1f} is {:.1f} Msun/yr'.format(halomass,
-    #       z_high, MAR))
+    if mar_table is None:
+        mar_table = get_mar_table()
 
-    delta_t = ((cosmo_mod.age(z_low) - cosmo_mod.age(z_high)) / u.Gyr) * 1e9 # convert to number of years
+    # Interpolate in redshift and halo mass to get mass accretion rate [Msun / yr]
+    MAR = mar_table(z_high, halomasses)
 
-    mass_accr = MAR * delta_t
+    mass_accr = MAR * calc_delta_t(z_high, z_low, cosmo_mod)
 
     return mass_accr
@@ -7,17 +7,30 @@ Created On: August 22 2022
 Description:
 
 Python code to add halo mass accretion over a redshift interval
-to an existing halo mass field.
+to an existing halo mass field. Only occupied voxels are processed, as a
+sparse (flat index, mass) list, and fields are saved in the sparse format
+of sparse_fields.py.
+
+With batch_interp = True, the high-z field is interpolated to every target
+redshift in target_zs in one pass: the accretion rates, cosmology and
+luminosity tables are shared across targets, and each target's fields are
+streamed to their own group of a single output file as they are produced.
 
 '''
 
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 import h5py
 import numpy as np
-import astropy.units as u
 import matplotlib.pyplot as plt
-from get_mar import calc_mass_accr
-from utility_funcs import (L_to_MAB, get_mag_app)
-from astropy.cosmology import FlatLambdaCDM
+from get_mar import (calc_delta_t, get_mar_table)
+from utility_funcs import (L_to_MAB, get_mag_app, survey_field_name)
+from survey_selection import (SurveySelection, SURVEY_CUTOFFS)
+from sparse_fields import (SparseFields, save_sparse_fields, write_sparse_fields)
+from cosmo_tables import CosmoTable
+from dtype_policy import get_policy
+from luminosity_relation import get_luminosity_relation
 
 # Load in data
 fname_zs = 'comoving_dist_redshift_conversion_BOX_LEN_128_zs_3.h5'
@@ -27,58 +40,103 @@ hf1.close()
 
 high_z = redshifts[-1]
 low_z = redshifts[1] # interpolation redshift
+batch_interp = False # interpolate to every redshift in target_zs instead of low_z only
+target_zs = redshifts[:-1] # e.g. all slice redshifts between coeval snapshots
 HII_DIM=int(np.copy(BOX_LEN))
 DIM = HII_DIM*3
 rseed=42142
 
 # Load in halo mass field at high_z to add mass to
 fname_cutoffs = f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/galaxy_cutoffs_HII_DIM_{HII_DIM}_DIM_{DIM}_BOXLEN_{BOX_LEN}_z_{high_z}_rseed_{rseed}.h5'
-hf2 = h5py.File(fname_cutoffs, 'r')
-halo_mass_bins, halo_mass_field = np.array(hf2['halo_mass_bins']), np.array(hf2['halo_mass_field'])
-hf2.close()
+# Only occupied voxels are read and interpolated, as a sparse (flat index, mass) list
+with SparseFields(fname_cutoffs) as fields:
+    halo_mass_bins = fields.hf['halo_mass_bins'][()]
+    occupied_inds, halo_masses = fields.sparse('halo_mass_field')
 
 print(f'\n ====== BOX_LEN: {BOX_LEN} ====== \n \n ====== (high_z, low_z): {high_z, low_z} ====== \n')
 
-# Generate cosmological model
-cosmo = FlatLambdaCDM(H0=67.32 * u.km / u.s / u.Mpc, Tcmb0=2.725 * u.K, Om0=0.3158)
+# Generate cosmological model (tabulated once, cached on disk)
+cosmo = CosmoTable(H0=67.32, Om0=0.3158, Tcmb0=2.725)
+
+# Galaxy luminosity-halo mass relation, L_1600(Mh, z) (parsed once, cached on disk)
+lum_rel = get_luminosity_relation()
+
+# Define apparent magnitude cutoffs of surveys (any number, see survey_selection.py)
+cutoffs = SURVEY_CUTOFFS
+selection = SurveySelection(cutoffs)
+
+def iter_interp_survey_fields(occupied_inds, halo_masses, high_z, target_zs):
+
+    '''
+    Generator interpolating the occupied voxels of the high_z halo mass field
+    to each target redshift. The mass accretion rate at high_z and the elapsed
+    times to all targets are computed once, so each target only costs one
+    luminosity conversion and one survey selection over the occupied voxels.
+    Yields (z, voxel_inds, voxel_masses, survey_masses, survey_counts).
+    '''
+
+    MAR = get_mar_table()(high_z, halo_masses) # [Msun / yr]
+    delta_ts = np.atleast_1d(calc_delta_t(high_z, np.asarray(target_zs), cosmo))
+
+    for z, delta_t in zip(np.atleast_1d(target_zs), delta_ts):
+
+        # Compute the halo mass to be added for a given halo mass, redshift interval
+        interp_halo_masses = halo_masses + MAR * delta_t
+
+        # Convert halo masses to luminosities
+        Lumo = lum_rel(z, interp_halo_masses)
+        MAB = L_to_MAB(Lumo)
+        mAB = get_mag_app(z, MAB, cosmo) # mAB at interpolation redshift
+
+        # Survey masses per occupied voxel (galaxies dimmer than threshold left out)
+        levels = selection.levels(mAB)
+        voxel_inds, voxel_masses, survey_masses = selection.sparse_fields(occupied_inds, interp_halo_masses,
+                                                                          levels, dtype=get_policy().field)
+        survey_counts = selection.counts(levels)
+
+        yield z, voxel_inds, voxel_masses, survey_masses, survey_counts
+
+def interp_fields(voxel_masses, survey_masses):
+
+    '''Function to name the interpolated fields as they are saved.'''
+
+    fields = {'inter_halo_mass_field': voxel_masses}
+    fields.update({survey_field_name(survey): v for survey, v in survey_masses.items()})
+
+    return fields
+
+if batch_interp:
+
+    fname_save = f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/interp_galaxy_cutoffs_HII_DIM_{HII_DIM}_DIM_{DIM}_BOXLEN_{BOX_LEN}_from_z_{high_z}_rseed_{rseed}_batch.h5'
+
+    with h5py.File(fname_save, 'w') as hf3:
+
+        hf3.create_dataset('redshifts', data=target_zs)
+        hf3.attrs['high_z'] = high_z
+
+        # One group per target redshift, written as soon as it is computed
+        for i, (z, voxel_inds, voxel_masses, survey_masses, survey_counts) in \
+                enumerate(iter_interp_survey_fields(occupied_inds, halo_masses, high_z, target_zs)):
 
-# Load in galaxy luminosity-halo mass relation data, parse data
-Mh_ML_dat = np.loadtxt('/Users/kennedyj/PHYS_459/L1600_vs_Mh_and_z.dat').T
-Mh, L_1600_z6, L_1600_z7, L_1600_z8, L_1600_z9, L_1600_z10 = Mh_ML_dat
+            grp = hf3.create_group(f'z_{i}')
+            grp.attrs['redshift'] = z
+            write_sparse_fields(grp, voxel_inds, interp_fields(voxel_masses, survey_masses), (HII_DIM,)*3)
+            hf3.flush()
 
-# Define apparent magnitude cutoffs of surveys
-cutoffs = {'JWST-UD': 32, 'JWST-MD': 30.6, 'JWST-WF': 29.3, 'Roman': 26.5}
+            print(f"\n ====== z = {z}: observable galaxies in each survey: {survey_counts} ====== \n")
 
-# Compute the halo mass to be added for a given halo mass, redshift interval
-halo_mass_field_accr = calc_mass_accr(high_z, low_z, halo_mass_field, cosmo)
-interp_halo_mass_field = halo_mass_field + halo_mass_field_accr
+    print(f'\n ====== File {fname_save} saved ====== \n')
 
-# Convert halo masses to luminosities
-Lumo = np.interp(interp_halo_mass_field, xp = Mh, fp = L_1600_z8)
-MAB = L_to_MAB(Lumo)
-mAB = get_mag_app(low_z, MAB, cosmo) # mAB at interpolation redshift
+else:
 
-# Copy interp halo mass field, zero out galaxies dimmer than survey threshold
-JWST_UD_gals = np.copy(interp_halo_mass_field)
-JWST_UD_gals[mAB > cutoffs['JWST-UD']] = 0
-JWST_MD_gals = np.copy(interp_halo_mass_field)
-JWST_MD_gals[mAB > cutoffs['JWST-MD']] = 0
-JWST_WF_gals = np.copy(interp_halo_mass_field)
-JWST_WF_gals[mAB > cutoffs['JWST-WF']] = 0
-Roman_gals = np.copy(interp_halo_mass_fields)
-Roman_gals[mAB > cutoffs['Roman']] = 0
+    z, voxel_inds, voxel_masses, survey_masses, survey_counts = \
+        next(iter_interp_survey_fields(occupied_inds, halo_masses, high_z, [low_z]))
 
-print(f"\n ====== Number of observable galaxies in each survey (JWST-UD, JWST-MD, JWST-WF, Roman): \
-	({np.count_nonzero(JWST_UD_gals)},{np.count_nonzero(JWST_MD_gals)},{np.count_nonzero(JWST_WF_gals)},{np.count_nonzero(Roman_gals)}) ====== \n")
+    print(f"\n ====== Number of observable galaxies in each survey: \
+	{survey_counts} ====== \n")
 
-fname_save = f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/interp_galaxy_cutoffs_HII_DIM_{HII_DIM}_DIM_{DIM}_BOXLEN_{BOX_LEN}_z_{low_z}_rseed_{rseed}.h5'
+    fname_save = f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/interp_galaxy_cutoffs_HII_DIM_{HII_DIM}_DIM_{DIM}_BOXLEN_{BOX_LEN}_z_{low_z}_rseed_{rseed}.h5'
 	
-hf3 = h5py.File(fname_save, 'w')
-hf3.create_dataset('inter_halo_mass_field', data=interp_halo_mass_field)
-hf3.create_dataset('JWST_UD_gals', data=JWST_UD_gals)
-hf3.create_dataset('JWST_MD_gals', data=JWST_MD_gals)
-hf3.create_dataset('JWST_WF_gals', data=JWST_WF_gals)
-hf3.create_dataset('Roman_gals', data=Roman_gals)
-hf3.close()
+    save_sparse_fields(fname_save, voxel_inds, interp_fields(voxel_masses, survey_masses), (HII_DIM,)*3)
 	
-print(f'\n ====== File {fname_save} saved ====== \n')
+    print(f'\n ====== File {fname_save} saved ====== \n')
@@ -0,0 +1,172 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Python code to stitch coeval galaxy and ionization boxes into lightcones.
+Line-of-sight cells are placed at consecutive comoving distances, converted
+to redshifts with the tabulated cosmology (cosmo_tables.py), and filled with
+the matching slice of the coeval boxes bracketing each cell's redshift.
+Slices are written block by block into preallocated, chunked HDF5 datasets
+(or .npy memmaps); only the two bracketing boxes are held in memory at any time, so lightcones
+with thousands of line-of-sight cells never sit in RAM.
+
+'''
+
+import os
+import h5py
+import numpy as np
+from cosmo_tables import CosmoTable
+from sparse_fields import SparseFields
+from utility_funcs import survey_field_name
+
+def open_lightcone(out, name, shape, dtype, block):
+
+    '''
+    Function to preallocate a lightcone array: a chunked dataset if out is an
+    open h5py File/Group, otherwise a .npy memmap named {name}.npy in directory out.
+    '''
+
+    if isinstance(out, h5py.Group):
+        return out.create_dataset(name, shape=shape, dtype=dtype,
+                                  chunks=shape[:2] + (min(block, shape[2]),))
+
+    os.makedirs(out, exist_ok=True)
+    return np.lib.format.open_memmap(os.path.join(out, f'{name}.npy'), mode='w+',
+                                     dtype=dtype, shape=shape)
+
+def assemble_lightcone(out, name, box_redshifts, load_box, slice_redshifts, interpolate=False,
+                       block=64, dtype=np.float32):
+
+    '''
+    Function to write a lightcone dataset slice by slice from coeval boxes.
+    ------------------------------------------------------------------------------
+    out:
+            Open h5py File (or Group) to create the lightcone dataset in, or
+            a directory to write the lightcone to as a .npy memmap.
+    name:
+            Name of the lightcone dataset, shape (HII_DIM, HII_DIM, num slices).
+    box_redshifts:
+            Redshift of each coeval box.
+    load_box:
+            Function k -> dense (HII_DIM, HII_DIM, HII_DIM) coeval box k.
+    slice_redshifts:
+            Redshift of each line-of-sight cell, increasing.
+    interpolate:
+            If True, interpolate linearly in redshift between the two bracketing
+            boxes (e.g. ionization fields), otherwise take the nearest box
+            (e.g. galaxy fields), default = False.
+    block:
+            Number of slices buffered per write (and chunk length along the
+            line of sight), default = 64.
+    dtype:
+            Lightcone dtype, default = np.float32.
+    ------------------------------------------------------------------------------
+    '''
+
+    order = np.argsort(box_redshifts)
+    zs = np.asarray(box_redshifts, dtype=np.float64)[order]
+    slice_redshifts = np.asarray(slice_redshifts, dtype=np.float64)
+    num_slices = len(slice_redshifts)
+
+    boxes = {} # at most the two bracketing boxes
+    def get_box(k):
+        if k not in boxes:
+            boxes[k] = np.asarray(load_box(order[k]), dtype=dtype)
+        return boxes[k]
+
+    HII_DIM = get_box(0).shape[0]
+    dset = open_lightcone(out, name, (HII_DIM, HII_DIM, num_slices), dtype, block)
+
+    # Bracketing boxes of every slice, clamped at the ends of the coeval redshifts
+    lo = np.clip(np.searchsorted(zs, slice_redshifts, side='right') - 1, 0, len(zs) - 1)
+    hi = np.minimum(lo + 1, len(zs) - 1)
+    dz = zs[hi] - zs[lo]
+    w = np.where(dz > 0, (slice_redshifts - zs[lo]) / np.where(dz > 0, dz, 1), 0.)
+    w = np.clip(w, 0, 1)
+
+    buffer = np.empty((HII_DIM, HII_DIM, min(block, num_slices)), dtype=dtype)
+    start = 0
+
+    for i in range(num_slices):
+
+        # Drop boxes that no later slice needs
+        for k in list(boxes):
+            if k not in (lo[i], hi[i]):
+                del boxes[k]
+
+        s = i % HII_DIM # periodic position of the slice within the coeval box
+        j = i - start
+
+        if interpolate:
+            buffer[:, :, j] = (1 - w[i]) * get_box(lo[i])[:, :, s] + w[i] * get_box(hi[i])[:, :, s]
+        else:
+            nearest = lo[i] if w[i] < 0.5 else hi[i]
+            buffer[:, :, j] = get_box(nearest)[:, :, s]
+
+        if j == buffer.shape[2] - 1 or i == num_slices - 1:
+            dset[:, :, start:i+1] = buffer[:, :, :j+1]
+            start = i + 1
+
+    if isinstance(dset, np.memmap):
+        dset.flush()
+
+    return dset
+
+def lightcone_slice_redshifts(d_start, num_slices, cell_size, cosmo):
+
+    '''
+    Function to return the comoving distances [Mpc] and redshifts of
+    num_slices consecutive line-of-sight cells starting at d_start.
+    '''
+
+    dist = d_start + np.arange(num_slices) * cell_size
+
+    return dist, cosmo.z_at_comoving_distance(dist)
+
+if __name__ == '__main__':
+
+    # Coeval box redshifts, BOX_LEN-spaced in comoving distance
+    fname_zs = 'comoving_dist_redshift_conversion_BOX_LEN_128_zs_3.h5'
+    with h5py.File(fname_zs, 'r') as hf1:
+        BOX_LEN, redshifts = int(np.array(hf1['BOX_LEN'])), np.array(hf1['redshifts'])
+        comoving_distances = np.array(hf1['comoving_distances'])
+
+    HII_DIM = BOX_LEN
+    DIM = HII_DIM*3
+    rseed = 42142
+    surveys = ['JWST-UD', 'JWST-MD', 'JWST-WF', 'Roman']
+    fname_cutoffs = [f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/galaxy_cutoffs_HII_DIM_{HII_DIM}_DIM_{DIM}_BOXLEN_{BOX_LEN}_z_{z}_rseed_{rseed}.h5' for z in redshifts]
+    fname_save = f'/Users/kennedyj/PHYS_459/lc-gen-gal-cutoffs/lightcone_HII_DIM_{HII_DIM}_BOXLEN_{BOX_LEN}_rseed_{rseed}.h5'
+
+    # One line-of-sight cell per HII_DIM cell, spanning all coeval boxes
+    cosmo = CosmoTable(H0=67.32, Om0=0.3158, Tcmb0=2.725)
+    num_slices = len(redshifts) * HII_DIM
+    dist, slice_redshifts = lightcone_slice_redshifts(comoving_distances[0], num_slices,
+                                                      BOX_LEN / HII_DIM, cosmo)
+
+    with h5py.File(fname_save, 'w') as hf:
+
+        hf.create_dataset('comoving_distances', data=dist)
+        hf.create_dataset('redshifts', data=slice_redshifts)
+
+        fields = ['halo_mass_field'] + [survey_field_name(s) for s in surveys]
+        with SparseFields(fname_cutoffs[0]) as f0:
+            if 'xH_box' in f0: # saved by get_gal_masses_field.py with gen_field = True
+                fields.append('xH_box')
+
+        for field in fields:
+
+            def load_box(k, field=field):
+                with SparseFields(fname_cutoffs[k]) as fields:
+                    return fields.dense(field)
+
+            # Ionization varies smoothly with z, galaxies are taken from the nearest box
+            assemble_lightcone(hf, field, redshifts, load_box, slice_redshifts,
+                               interpolate=(field == 'xH_box'))
+            print(f'\n ====== {field} lightcone written ====== \n')
+
+    print(f'\n ====== File {fname_save} saved ====== \n')
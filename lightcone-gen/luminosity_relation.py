@@ -0,0 +1,92 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Python code for the galaxy UV luminosity - halo mass relation of
+L1600_vs_Mh_and_z.dat (columns Mh, L_1600 at z = 6, 7, 8, 9, 10). The text
+table is parsed once and cached on disk as .npz, keyed by the path, size and
+mtime of the .dat file. Luminosities are interpolated bilinearly in
+(log10 Mh, z) on log10 L, so whole halo arrays at any mix of redshifts are
+converted in a single call.
+
+'''
+
+import os
+import numpy as np
+from utility_funcs import L_to_MAB
+from table_cache import (table_cache_key, load_tables, bilinear_interp)
+
+LUMINOSITY_FILE = '/Users/kennedyj/PHYS_459/L1600_vs_Mh_and_z.dat'
+LUMINOSITY_REDSHIFTS = (6., 7., 8., 9., 10.) # redshifts of the L_1600 columns
+DEFAULT_CACHE_DIR = os.environ.get('LUM_CACHE_DIR',
+                                   os.path.expanduser('~/.cache/galaxy-mapping/luminosity'))
+
+class LuminosityRelation:
+
+    """
+    L_1600(Mh, z) table, served from a local .npz cache of the .dat file.
+    ----------
+    Attributes
+    :fname:    (str) Path of the L1600_vs_Mh_and_z.dat table.
+    :tab_z:    (array) Redshift grid (increasing).
+    :tab_logM: (array) log10 halo mass grid [Msun] (increasing).
+    :tab_logL: (array) log10 L_1600 [erg / s / Hz], shape (len(tab_z), len(tab_logM)).
+    """
+
+    def __init__(self, fname: str = LUMINOSITY_FILE, cache_dir: str = DEFAULT_CACHE_DIR):
+
+        self.fname = fname
+        stat = os.stat(fname)
+        key = table_cache_key((os.path.abspath(fname), stat.st_size, stat.st_mtime))
+        tables = load_tables(os.path.join(cache_dir, f'luminosity_table_{key}.npz'),
+                             lambda: self.build_tables(fname))
+
+        self.tab_z = tables['tab_z']
+        self.tab_logM = tables['tab_logM']
+        self.tab_logL = tables['tab_logL']
+
+    @staticmethod
+    def build_tables(fname):
+        """Parses the .dat table and returns its sorted log tables"""
+
+        Mh_ML_dat = np.loadtxt(fname).T
+        Mh, L_1600 = Mh_ML_dat[0], Mh_ML_dat[1:]
+
+        iM = np.argsort(Mh)
+        tab_logM = np.log10(Mh[iM])
+        # Zero luminosities are floored so they stay (vanishingly) dim after interpolation
+        tab_logL = np.log10(np.maximum(L_1600[:, iM], np.finfo(np.float64).tiny))
+
+        return {'tab_z': np.array(LUMINOSITY_REDSHIFTS), 'tab_logM': tab_logM, 'tab_logL': tab_logL}
+
+    def __call__(self, z, halomasses):
+        """
+        Vectorized bilinear interpolation of L_1600 [erg / s / Hz] in
+        (log10 Mh, z). z and halomasses are broadcast against each other;
+        values outside the tables are clamped to the table edges, as np.interp does.
+        """
+
+        z, logM = np.broadcast_arrays(np.asarray(z, dtype=np.float64),
+                                      np.log10(np.asarray(halomasses, dtype=np.float64)))
+
+        return 10**bilinear_interp(self.tab_z, self.tab_logM, self.tab_logL, z, logM)
+
+    def MAB(self, z, halomasses):
+        """Absolute UV magnitudes of halos at redshifts z"""
+
+        return L_to_MAB(self(z, halomasses))
+
+_luminosity_relation = None
+
+def get_luminosity_relation():
+    '''
+    Function to return the default LuminosityRelation, loaded once per process.
+    '''
+    global _luminosity_relation
+    if _luminosity_relation is None:
+        _luminosity_relation = LuminosityRelation()
+    return _luminosity_relation
@@ -0,0 +1,168 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Python code for the sparse on-disk format of halo mass and galaxy survey
+fields. Instead of one dense HII_DIM^3 float64 dataset per field, a file
+stores the flat indices of the occupied voxels once ('voxel_inds') and, per
+field, the values at those voxels, aligned with voxel_inds and compressed.
+Files are marked with the attribute format = 'sparse' and the field shape.
+
+SparseFields reads both sparse and legacy dense files: fields can be densified
+on demand, iterated sparsely, or counted/summed without materializing dense
+boxes.
+
+'''
+
+import h5py
+import numpy as np
+
+def save_sparse_fields(fname, voxel_inds, fields, shape, extra=None):
+
+    '''
+    Function to save fields in the sparse format.
+    ------------------------------------------------------------------------------
+    fname:
+            Name of the .h5 file to write.
+    voxel_inds:
+            Sorted, unique flat indices of the occupied voxels.
+    fields:
+            Dict of field name -> values at voxel_inds.
+    shape:
+            Shape of the dense fields, e.g. (HII_DIM, HII_DIM, HII_DIM).
+    extra:
+            Optional dict of small datasets stored as is (e.g. halo_mass_bins).
+    ------------------------------------------------------------------------------
+    '''
+
+    with h5py.File(fname, 'w') as hf:
+        write_sparse_fields(hf, voxel_inds, fields, shape, extra=extra)
+
+def write_sparse_fields(group, voxel_inds, fields, shape, extra=None):
+
+    '''
+    Function to write fields in the sparse format into an open h5py File or
+    Group, e.g. one group per redshift of a multi-redshift file.
+    '''
+
+    index_dtype = np.uint32 if np.prod(shape) < 2**32 else np.uint64
+
+    group.attrs['format'] = 'sparse'
+    group.attrs['shape'] = np.asarray(shape)
+    kwargs = {'compression': 'lzf', 'shuffle': True} if len(voxel_inds) else {}
+    group.create_dataset('voxel_inds', data=np.asarray(voxel_inds, dtype=index_dtype), **kwargs)
+
+    for k, v in fields.items():
+        group.create_dataset(k, data=v, **kwargs)
+
+    for k, v in (extra or {}).items():
+        group.create_dataset(k, data=v)
+
+def save_dense_fields_sparse(fname, fields, extra=None):
+
+    '''
+    Function to save dense fields of equal shape in the sparse format, the
+    occupied voxels being the union of the nonzero voxels of all fields.
+    '''
+
+    shape = next(iter(fields.values())).shape
+    occupied = np.zeros(np.prod(shape), dtype=bool)
+    for v in fields.values():
+        occupied |= np.ravel(v) != 0
+    voxel_inds = np.flatnonzero(occupied)
+
+    save_sparse_fields(fname, voxel_inds, {k: np.ravel(v)[voxel_inds] for k, v in fields.items()},
+                       shape, extra=extra)
+
+class SparseFields:
+
+    """
+    Reader for sparse (and legacy dense) field files.
+    ----------
+    Attributes
+    :fname:  (str) Name of the .h5 file.
+    :group:  (str) Optional group of the file holding the fields.
+    :sparse_format: (bool) True if the file uses the sparse format.
+    :shape:  (tuple) Shape of the dense fields.
+    """
+
+    def __init__(self, fname: str, group: str = None):
+
+        self.fname = fname
+        self._file = h5py.File(fname, 'r')
+        self.hf = self._file if group is None else self._file[group]
+        self.sparse_format = self.hf.attrs.get('format') == 'sparse'
+        self._voxel_inds = None
+
+        if self.sparse_format:
+            self.shape = tuple(int(d) for d in self.hf.attrs['shape'])
+        else:
+            self.shape = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.hf
+
+    def close(self):
+        self._file.close()
+
+    @property
+    def voxel_inds(self):
+        if self._voxel_inds is None:
+            self._voxel_inds = self.hf['voxel_inds'][:].astype(np.int64)
+        return self._voxel_inds
+
+    def dense(self, name: str):
+        """Returns field name as a dense array"""
+
+        # Dense datasets stored as is (legacy files, or extra boxes of sparse files)
+        if not self.sparse_format or self.hf[name].shape == self.shape:
+            return self.hf[name][()]
+
+        field = np.zeros(self.shape, dtype=self.hf[name].dtype)
+        field.flat[self.voxel_inds] = self.hf[name][:]
+
+        return field
+
+    def sparse(self, name: str):
+        """Returns (flat voxel indices, values) of the nonzero voxels of field name"""
+
+        if self.sparse_format:
+            inds, values = self.voxel_inds, self.hf[name][:]
+        else:
+            values = np.ravel(self.hf[name][()])
+            inds = np.arange(values.size)
+
+        nonzero = values != 0
+
+        return inds[nonzero], values[nonzero]
+
+    def _chunks(self, name, chunk_size):
+        """Yields field name in 1-D chunks, without densifying sparse files"""
+
+        dset = self.hf[name]
+        if self.sparse_format or dset.ndim <= 1:
+            for i in range(0, dset.shape[0], chunk_size):
+                yield dset[i:i+chunk_size]
+        else:
+            for i in range(dset.shape[0]):
+                yield dset[i]
+
+    def count_nonzero(self, name: str, chunk_size: int = 2**20):
+        """Number of nonzero voxels of field name"""
+
+        return int(sum(np.count_nonzero(chunk) for chunk in self._chunks(name, chunk_size)))
+
+    def sum(self, name: str, chunk_size: int = 2**20):
+        """Sum of field name over all voxels"""
+
+        return float(sum(np.sum(chunk, dtype=np.float64) for chunk in self._chunks(name, chunk_size)))
@@ -0,0 +1,99 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Python code for selecting galaxies by survey apparent magnitude limits. A
+survey definition is any dict of survey name -> limiting magnitude, e.g. the
+four surveys of SURVEY_CUTOFFS or dozens of hypothetical depths from
+magnitude_grid.
+
+Surveys are sorted from shallowest to deepest once, and each halo is given,
+with a single np.searchsorted, its level: the index of the shallowest survey
+it is visible in (a halo is visible in sorted survey j iff level <= j).
+Per-survey counts, masks and mass fields all follow from the levels with one
+np.bincount and a cumulative sum, so the cost of adding surveys does not
+scale with the number of halos.
+
+'''
+
+import numpy as np
+
+# Apparent magnitude limits of the surveys used so far
+SURVEY_CUTOFFS = {'JWST-UD': 32, 'JWST-MD': 30.6, 'JWST-WF': 29.3, 'Roman': 26.5}
+
+def magnitude_grid(m_min, m_max, step, prefix='m_lim'):
+
+    '''
+    Function to return a survey definition of hypothetical surveys with limiting
+    magnitudes m_min, m_min + step, ..., m_max, named e.g. 'm_lim_28.5'.
+    '''
+
+    limits = np.round(np.arange(m_min, m_max + step / 2, step), 6)
+
+    return {f'{prefix}_{m:g}': float(m) for m in limits}
+
+class SurveySelection:
+
+    """
+    Single pass selection of halos by the magnitude limits of many surveys.
+    ----------
+    Attributes
+    :cutoffs: (dict) Survey name -> limiting apparent magnitude.
+    :names:   (list) Survey names, shallowest (brightest limit) first.
+    :limits:  (array) Limiting magnitudes in the order of names.
+    """
+
+    def __init__(self, cutoffs: dict = SURVEY_CUTOFFS):
+
+        self.cutoffs = dict(cutoffs)
+        self.names = sorted(self.cutoffs, key=self.cutoffs.get)
+        self.limits = np.array([self.cutoffs[name] for name in self.names], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def levels(self, mags):
+        """
+        Index of the shallowest survey each halo is visible in (mags < limit),
+        len(self) if it is in none.
+        """
+
+        return np.searchsorted(self.limits, mags, side='right')
+
+    def counts(self, levels):
+        """Dict of survey name -> number of visible halos"""
+
+        counts = np.cumsum(np.bincount(levels, minlength=len(self) + 1)[:len(self)])
+
+        return {name: int(counts[j]) for j, name in enumerate(self.names)}
+
+    def masks(self, levels):
+        """Yields (survey name, boolean visibility mask) per survey, one mask at a time"""
+
+        for j, name in enumerate(self.names):
+            yield name, levels <= j
+
+    def sparse_fields(self, flat_inds, halo_masses, levels, dtype=np.float64):
+        """
+        Sums halo masses per occupied voxel, in total and per survey.
+
+        One np.bincount over (level, occupied voxel) gives the mass per level,
+        and a cumulative sum over the sorted surveys yields every survey.
+        Masses are summed in float64 and returned as dtype.
+
+        Returns the sorted occupied flat voxel indices, the halo mass per
+        occupied voxel and a dict of survey name -> survey mass per occupied voxel.
+        """
+
+        voxel_inds, inverse = np.unique(flat_inds, return_inverse=True)
+        num_occ = len(voxel_inds)
+
+        level_masses = np.bincount(levels * num_occ + inverse.reshape(-1), weights=halo_masses,
+                                   minlength=(len(self) + 1) * num_occ)
+        masses = np.cumsum(level_masses.reshape(len(self) + 1, num_occ), axis=0).astype(dtype, copy=False)
+
+        return voxel_inds, masses[-1], {name: masses[j] for j, name in enumerate(self.names)}
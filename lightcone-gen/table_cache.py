@@ -0,0 +1,72 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Shared helpers of the tabulated lookups of lightcone-gen (CosmoTable,
+MARTable, LuminosityRelation). Tables are dicts of arrays, built once and
+cached on local disk as .npz files named by a hash of their inputs, and
+looked up by (bi)linear interpolation with edge clamping.
+
+'''
+
+import os
+import hashlib
+import numpy as np
+
+def table_cache_key(inputs):
+
+    '''Function to return the short content hash naming the cache file of inputs.'''
+
+    return hashlib.sha1(repr(inputs).encode()).hexdigest()[:16]
+
+def load_tables(fname, build):
+
+    '''
+    Function to return the dict of arrays cached in the .npz file fname. On a
+    miss the tables are built with build() and saved atomically (tmp file,
+    then os.replace), so concurrent processes never read a partial file.
+    fname None disables the cache.
+    '''
+
+    if fname is not None and os.path.isfile(fname):
+        with np.load(fname) as cached:
+            return dict(cached)
+
+    tables = build()
+    if fname is not None:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_name = fname + '.tmp.npz'
+        np.savez(tmp_name, **tables)
+        os.replace(tmp_name, fname)
+
+    return tables
+
+def bracket(grid, x):
+
+    '''
+    Function to return the lower index into the increasing grid and the
+    (clamped) linear weight of x.
+    '''
+
+    i = np.clip(np.searchsorted(grid, x) - 1, 0, len(grid) - 2)
+    w = np.clip((x - grid[i]) / (grid[i + 1] - grid[i]), 0, 1)
+
+    return i, w
+
+def bilinear_interp(grid_x, grid_y, table, x, y):
+
+    '''
+    Function to interpolate table (shape (len(grid_x), len(grid_y))) bilinearly
+    at (x, y), broadcast against each other. Values outside the grids are
+    clamped to the table edges, as np.interp does.
+    '''
+
+    ix, wx = bracket(grid_x, x)
+    iy, wy = bracket(grid_y, y)
+
+    return ((1 - wx) * ((1 - wy) * table[ix, iy] + wy * table[ix, iy + 1])
+            + wx * ((1 - wy) * table[ix + 1, iy] + wy * table[ix + 1, iy + 1]))
@@ -26,12 +26,22 @@ def L_to_MAB(L):
 
 def get_mag_app(z, mags, cosmo_model):
     """
-    Convert absolute magnitudes to apparent magnitudes.
+    Convert absolute magnitudes to apparent magnitudes. cosmo_model is an
+    astropy cosmology or a cosmo_tables.CosmoTable (distances in Mpc).
     """
-    d_pc = 1e6*cosmo_model.luminosity_distance(z) / u.Mpc
+    d_Mpc = cosmo_model.luminosity_distance(z)
+    if isinstance(d_Mpc, u.Quantity):
+        d_Mpc = d_Mpc.to_value(u.Mpc)
+    d_pc = 1e6*d_Mpc
 
     return mags + 5 * np.log10(d_pc / 10.) - 2.5 * np.log10(1. + z)
 
+def survey_field_name(survey):
+    """
+    Name of the dataset holding a survey's galaxy field, e.g. 'JWST-UD' -> 'JWST_UD_gals'.
+    """
+    return survey.replace('-', '_') + '_gals'
+
 '''
 def plot_slice_gals(box, ax=None, fig=None):
 	# plot_slice(bt_boxes[0])
@@ -0,0 +1,283 @@
+'''
+
+Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
+
+Created On: October 17 2026
+
+Description:
+
+Directory-level manifest of HDF5 data products. Every .h5 file under a data
+directory is opened once and its datasets (shape, dtype), file attributes and
+per-box redshifts and random seeds are recorded in a compact json index
+stored in the directory. Redshifts and seeds are taken from 'redshifts' /
+'random_seeds' datasets, redshift / random_seed attributes (including the
+stringified seed lists of the coeval box files), per-redshift groups or, as a
+last resort, the _z_{z} / rseed_{n} parts of the file name. Redshift / seed
+datasets are only used if they run along the box axis; the per-halo columns
+of halo catalogs are skipped and their offsets table is indexed instead, one
+entry per (seed, redshift) block.
+
+The manifest is refreshed incrementally (only new or modified files are
+re-read), and queries such as "all boxes at z ~ 8 for seeds in X" are
+answered from the index without opening any HDF5 file:
+
+    manifest = Manifest('/Users/kennedyj/PHYS_459/data/coeval_boxes/')
+    for path, index, groups in manifest.find(redshift=8, seeds=[50, 100]):
+        ...
+
+'''
+
+import os
+import re
+import json
+import h5py
+import argparse
+import numpy as np
+from glob import glob
+
+# Datasets / attributes holding per-box redshifts and random seeds
+REDSHIFT_KEYS = ('redshifts', 'redshift')
+SEED_KEYS = ('random_seeds', 'random_seeds_val', 'random_seed', 'rseeds')
+
+# Stringified attributes are truncated to keep the manifest compact
+MAX_ATTR_LEN = 256
+
+def parse_seeds(value):
+
+    '''
+    Function to return a list of int random seeds from a seed dataset or
+    attribute: an int, an array, or a stringified list such as '[50 100 150]'
+    or '[np.int64(50), np.int64(100)]'. Returns None if a string is not a
+    plain list of integers.
+    '''
+
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        value = re.sub(r'(?:np|numpy)\.\w+\(([^()]*)\)', r'\1', value)
+        tokens = [t for t in re.split(r'[\s,\[\]()]+', value) if t]
+        if not tokens or not all(re.fullmatch(r'-?\d+', t) for t in tokens):
+            return None
+        return [int(t) for t in tokens]
+
+    return [int(s) for s in np.atleast_1d(value)]
+
+def parse_filename(fname):
+
+    '''
+    Function to return the (redshift, random seed) encoded in a file name as
+    _z_{z} and rseed_{n}, None where absent.
+    '''
+
+    basename = os.path.basename(fname)
+    z = re.search(r'_z_(\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)', basename)
+    rseed = re.search(r'rseed_(\d+)', basename)
+
+    return (float(z.group(1)) if z else None, int(rseed.group(1)) if rseed else None)
+
+def box_axis_lengths(hf):
+
+    '''
+    Function to return the possible lengths of the box axis of an open HDF5
+    file: the first axis of stacks of boxes and the line-of-sight (last) axis
+    of lightcones.
+    '''
+
+    lengths = set()
+    for v in hf.values():
+        if isinstance(v, h5py.Dataset):
+            if v.ndim >= 4:
+                lengths.add(v.shape[0])
+            elif v.ndim == 3:
+                lengths.add(v.shape[-1])
+
+    return lengths
+
+def read_manifest_entry(fname):
+
+    '''
+    Function to read the datasets, attributes, redshifts and random seeds of
+    one HDF5 file. Only the small 1-D redshift / seed datasets are read.
+    '''
+
+    entry = {'datasets': {}, 'attrs': {}, 'redshifts': None, 'seeds': None, 'groups': None}
+
+    with h5py.File(fname, 'r') as hf:
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset):
+                entry['datasets'][name] = [list(obj.shape), str(obj.dtype)]
+        hf.visititems(visit)
+
+        for k, v in hf.attrs.items():
+            entry['attrs'][k] = str(v)[:MAX_ATTR_LEN]
+
+        # Halo catalogs, indexed by the (seed, redshift) blocks of their offsets table
+        if 'offsets' in hf and isinstance(hf['offsets'], h5py.Group) \
+                and 'seed' in hf['offsets'] and 'redshift' in hf['offsets']:
+            entry['redshifts'] = [float(z) for z in hf['offsets/redshift'][:]]
+            entry['seeds'] = [int(s) for s in hf['offsets/seed'][:]]
+            return entry
+
+        # Per-redshift groups, e.g. z_{i} of batch interpolation files
+        groups = sorted((k for k in hf if isinstance(hf[k], h5py.Group) and 'redshift' in hf[k].attrs),
+                        key=lambda k: (len(k), k))
+        if groups:
+            entry['groups'] = groups
+            entry['redshifts'] = [float(hf[k].attrs['redshift']) for k in groups]
+
+        lengths = box_axis_lengths(hf) | {1}
+        def along_box_axis(k):
+            return k in hf and isinstance(hf[k], h5py.Dataset) and hf[k].ndim <= 1 and hf[k].size in lengths
+
+        if entry['redshifts'] is None:
+            for k in REDSHIFT_KEYS:
+                if along_box_axis(k):
+                    entry['redshifts'] = [float(z) for z in np.atleast_1d(hf[k][()])]
+                    break
+                if k in hf.attrs:
+                    entry['redshifts'] = [float(z) for z in np.atleast_1d(hf.attrs[k])]
+                    break
+
+        for k in SEED_KEYS:
+            if along_box_axis(k):
+                entry['seeds'] = parse_seeds(hf[k][()])
+                break
+            if k in hf.attrs:
+                entry['seeds'] = parse_seeds(hf.attrs[k])
+                break
+
+    z, rseed = parse_filename(fname)
+    if entry['redshifts'] is None and z is not None:
+        entry['redshifts'] = [z]
+    if entry['seeds'] is None and rseed is not None:
+        entry['seeds'] = [rseed]
+
+    return entry
+
+class Manifest:
+
+    """
+    Incrementally refreshed manifest of the HDF5 files of a data directory.
+    ----------
+    Attributes
+    :data_dir:      (str) Directory scanned (recursively) for .h5 files.
+    :manifest_file: (str) Path of the persisted json manifest.
+    :entries:       (dict) relative path -> {'mtime', 'size', 'datasets',
+                           'attrs', 'redshifts', 'seeds', 'groups'}.
+    """
+
+    def __init__(self, data_dir: str, manifest_file: str = None, refresh: bool = True):
+
+        self.data_dir = data_dir
+        self.manifest_file = manifest_file or os.path.join(data_dir, '.manifest.json')
+        self.entries = {}
+
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.entries = json.load(f)
+
+        if refresh:
+            self.refresh()
+
+    def refresh(self):
+        """Re-reads new or modified files, drops deleted ones"""
+
+        paths = {os.path.relpath(p, self.data_dir)
+                 for p in glob(os.path.join(self.data_dir, '**', '*.h5'), recursive=True)}
+        updated = False
+
+        for path in set(self.entries) - paths:
+            del self.entries[path]
+            updated = True
+
+        for path in sorted(paths):
+            st = os.stat(os.path.join(self.data_dir, path))
+            entry = self.entries.get(path)
+            if entry is not None and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size:
+                continue
+            try:
+                entry = read_manifest_entry(os.path.join(self.data_dir, path))
+            except OSError:
+                continue # file still being written
+            entry['mtime'] = st.st_mtime
+            entry['size'] = st.st_size
+            self.entries[path] = entry
+            updated = True
+
+        if updated:
+            self.save()
+
+    def save(self):
+        """Writes the manifest to manifest_file atomically"""
+
+        tmp_name = self.manifest_file + '.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump(self.entries, f, separators=(',', ':'))
+        os.replace(tmp_name, self.manifest_file)
+
+    def path(self, path: str) -> str:
+        """Absolute path of a manifest entry"""
+
+        return os.path.join(self.data_dir, path)
+
+    def find(self, redshift: float = None, seeds=None, tol: float = 0.05,
+             dataset: str = None, pattern: str = None):
+        """
+        Returns a list of (path, box indices, groups) of the boxes with
+        |z - redshift| <= tol and a seed in seeds, in files holding dataset and
+        whose relative path matches the regex pattern (any if None). Box indices
+        index the file's per-box redshifts (the first axis of its box
+        datasets), or the offsets table of halo catalogs; groups are the
+        matching per-redshift groups, or None.
+        """
+
+        seeds = None if seeds is None else set(int(s) for s in np.atleast_1d(seeds))
+        matches = []
+
+        for path, e in sorted(self.entries.items()):
+
+            if dataset is not None and dataset not in e['datasets']:
+                continue
+            if pattern is not None and not re.search(pattern, path):
+                continue
+
+            num = max(len(e['redshifts'] or []), len(e['seeds'] or []), 1)
+            keep = np.ones(num, dtype=bool)
+
+            if redshift is not None:
+                if not e['redshifts'] or len(e['redshifts']) not in (1, num):
+                    continue
+                zs = np.broadcast_to(np.asarray(e['redshifts']), (num,))
+                keep &= np.abs(zs - redshift) <= tol
+
+            if seeds is not None:
+                if not e['seeds'] or len(e['seeds']) not in (1, num):
+                    continue
+                file_seeds = np.broadcast_to(np.asarray(e['seeds']), (num,))
+                keep &= np.isin(file_seeds, list(seeds))
+
+            index = np.flatnonzero(keep)
+            if len(index):
+                groups = None if e['groups'] is None else [e['groups'][i] for i in index]
+                matches.append((path, index.tolist(), groups))
+
+        return matches
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Build / query the manifest of a data directory.')
+    parser.add_argument('data_dir', help='Directory of .h5 files.')
+    parser.add_argument('--z', type=float, default=None, help='Redshift of the boxes to find.')
+    parser.add_argument('--tol', type=float, default=0.05, help='Redshift tolerance.')
+    parser.add_argument('--seeds', type=int, nargs='*', default=None, help='Random seeds of the boxes to find.')
+    parser.add_argument('--dataset', default=None, help='Only files holding this dataset.')
+    args = parser.parse_args()
+
+    manifest = Manifest(args.data_dir)
+    print(f"\n ====== {len(manifest.entries)} files in {manifest.manifest_file} ====== \n")
+
+    if args.z is not None or args.seeds is not None or args.dataset is not None:
+        for path, index, groups in manifest.find(redshift=args.z, seeds=args.seeds, tol=args.tol,
+                                                 dataset=args.dataset):
+            print(f"\t{path}: boxes {index}" + (f", groups {groups}" if groups else ''))
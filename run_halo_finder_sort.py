@@ -1,4 +1,4 @@
-''' 
+'''
 
 Author: Jacob Kennedy (jacob.kennedy@mail.mcgill.ca)
 
@@ -6,62 +6,131 @@ Created on: August 20 2022
 
 Description:
 
-Python script designed to take as input pairs of 21cmFAST generated (gt) 
+Python script designed to take as input pairs of 21cmFAST generated (gt)
 and U-Net predicted (pred) ionization fields, run the 21cmFAST
-halo finder on the initial density field and generate lists of halos 
+halo finder on the initial density field and generate lists of halos
 based on their location in either ionized or neutral regions of the field.
 
+Random seeds are processed in parallel by a pool of worker processes, each
+limited to --threads_per_worker threads. Seeds whose *_halos.h5 output
+already exists and is complete are skipped, and outputs are written
+atomically, so a killed job can simply be restarted.
+
 '''
 
-import h5py
+import os
+import sys
+import argparse
+
+# Limit threads per worker before numpy/21cmFAST are imported
+parser = argparse.ArgumentParser(description='Run the 21cmFAST halo finder and sort halos for every random seed.')
+parser.add_argument('--num_workers', type=int, default=None,
+                    help='Number of worker processes (default: cpu_count // threads_per_worker).')
+parser.add_argument('--threads_per_worker', type=int, default=1,
+                    help='OpenMP threads used by each worker.')
+args, _ = parser.parse_known_args()
+for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ[var] = str(args.threads_per_worker)
+
 import numpy as np
 import py21cmfast as p21c
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from data_manager import DataManager
-from utility_funcs import (binarize_boxes, get_n_i_halo_mass_coords)
+from halo_cache import HaloCache
+from utility_funcs import (binarize_boxes, get_n_i_halo_mass_coords,
+                           n_i_halo_file_complete)
 
 # Load in coeval boxes
 fname_coeval_boxes= '/Users/kennedyj/PHYS_459/data/coeval_boxes/_128_128_rseed_variable_Jun27_results.h5'
-DM = DataManager(fname_coeval_boxes)
-xH_boxes_pred = binarize_boxes(DM.data["predicted_brightness_temp_boxes"])
-xH_boxes_gt = binarize_boxes(DM.data["ionized_boxes"])
-rseeds = DM.dset_attrs['random_seed'].split()
-redshifts = DM.data['redshifts']
-num_rseeds = len(rseeds)
-
-# Break up string list into ints to process
-for j in range(num_rseeds):
-
-    if j==0:
-        rseeds[0] = int(rseeds[0][1:-1])
-    elif j==(num_rseeds-1):
-        rseeds[-1] = int(rseeds[-1][:-2])
-    else:
-        rseeds[j] = int(rseeds[j][:-1])
+save_dir = '/Users/kennedyj/PHYS_459/data/halo_masses_coords/'
 
 # Coeval cube parameters
 BOX_LEN = 128
 HII_DIM = 128
 DIM = 128*3
-user_params = p21c.UserParams(BOX_LEN=BOX_LEN,
-    		                  HII_DIM=HII_DIM,
-    		                  USE_INTERPOLATION_TABLES=True)
 
-# Run halo finder on each rseed coeval cube
-for k in range(num_rseeds):
+def get_save_name(rseed):
+
+    '''Function to return the halo file name for a random seed.'''
+
+    return save_dir + f"HII_DIM_{HII_DIM}_DIM_{DIM}_BOX_LEN_{BOX_LEN}_rseed_{rseed}_halos.h5"
+
+def parse_rseeds(rseed_attr):
+
+    '''Function to break up the stringified random_seed attribute into ints.'''
+
+    rseeds = rseed_attr.split()
+    num_rseeds = len(rseeds)
+
+    for j in range(num_rseeds):
+
+        if j==0:
+            rseeds[0] = int(rseeds[0][1:-1])
+        elif j==(num_rseeds-1):
+            rseeds[-1] = int(rseeds[-1][:-2])
+        else:
+            rseeds[j] = int(rseeds[j][:-1])
+
+    return rseeds
+
+def find_and_sort_halos(k, rseed, redshift, threads):
+
+    '''
+    Worker: run the halo finder on random seed rseed and sort its halos
+    against box k of the gt/pred ionization fields.
+    '''
+
+    user_params = p21c.UserParams(BOX_LEN=BOX_LEN,
+                                  HII_DIM=HII_DIM,
+                                  USE_INTERPOLATION_TABLES=True,
+                                  N_THREADS=threads)
+
+    # Initial conditions and halo finder only run on a halo cache miss
+    halo_field = HaloCache().determine_halo_list(redshift=redshift,
+                                                 user_params=user_params,
+                                                 random_seed=rseed)
+
+    halo_coords = halo_field['halo_coords'] # currently in DIM coords
+    halo_masses = halo_field['halo_masses']
+
+    # Each worker reads (and binarizes) only its own box
+    DM = DataManager(fname_coeval_boxes, keys=["predicted_brightness_temp_boxes", "ionized_boxes"], index=[k])
+    xH_box_pred = binarize_boxes(DM.data["predicted_brightness_temp_boxes"], dtype=bool)[0]
+    xH_box_gt = binarize_boxes(DM.data["ionized_boxes"], dtype=bool)[0]
+
+    save_name = get_save_name(rseed)
+    get_n_i_halo_mass_coords(halo_coords, halo_masses, xH_box_gt,
+                             xH_box_pred, rseed, save_name)
+
+    return rseed
+
+if __name__ == '__main__':
+
+    with DataManager(fname_coeval_boxes, lazy=True) as DM:
+        rseeds = parse_rseeds(DM.dset_attrs['random_seed'])
+        redshifts = np.array(DM.data['redshifts'])
+
+    # Skip random seeds already processed by a previous (possibly killed) run
+    todo = [k for k in range(len(rseeds)) if not n_i_halo_file_complete(get_save_name(rseeds[k]))]
+    print(f"\n ====== {len(rseeds) - len(todo)} of {len(rseeds)} random seeds already done ====== \n")
 
-    init_cond = p21c.initial_conditions(user_params=user_params,
-                                        random_seed=rseeds[k])
+    num_workers = args.num_workers or max(1, os.cpu_count() // args.threads_per_worker)
 
-    halo_field = p21c.determine_halo_list(redshift=redshifts[k],
-                                          init_boxes=init_cond,
-                                          user_params=user_params)
-            
-    halo_coords = halo_field.halo_coords # currently in DIM coords
-    halo_masses = halo_field.halo_masses
+    # Run halo finder on each rseed coeval cube
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
 
-    save_name = f"/Users/kennedyj/PHYS_459/data/halo_masses_coords/HII_DIM_{HII_DIM}_DIM_{DIM}_BOX_LEN_{BOX_LEN}_rseed_{rseeds[k]}_halos.h5"
+        futures = {pool.submit(find_and_sort_halos, k, rseeds[k], redshifts[k],
+                               args.threads_per_worker): rseeds[k] for k in todo}
 
-    get_n_i_halo_mass_coords(halo_coords, halo_masses, xH_boxes_gt[k], 
-    						xH_boxes_pred[k], rseeds[k], save_name)
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"\n ====== rseed {futures[future]} failed: {e!r} ====== \n")
+                failed.append(futures[future])
 
+    # Nonzero exit status so batch runners can tell a partial run from a complete one
+    if failed:
+        sys.exit(f"\n ====== {len(failed)} of {len(todo)} random seeds failed, rerun to resume: {sorted(failed)} ====== \n")
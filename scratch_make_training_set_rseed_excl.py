@@ -8,6 +8,8 @@ Description:
 
 Python code to organize previously generated 21cmFAST coeval cubes and 
 their wedge-filtered counterparts into a single training set for the U-Net.
+Boxes are streamed from each per-seed file directly into their shuffled slot
+of the output file, so peak memory is about one box per dataset.
 
 '''
 
@@ -20,7 +22,8 @@ import numpy as np
 import matplotlib.pyplot as plt
 from typing import Optional, List
 from data_manager import DataManager
-from utility_funcs import save_dset_to_hf
+from utility_funcs import (box_storage_kwargs, report_write_throughput)
+from dtype_policy import get_policy
 
 # User params, random seeds of 21cmFAST fields
 HII_DIM = 128
@@ -36,37 +39,9 @@ num_train = 400
 num_val = 100
 num_boxes = num_val+num_train
 
-# Arrays to cast boxes into
-new_bt_boxes = np.zeros((num_boxes, HII_DIM, HII_DIM, HII_DIM)) 
-new_ion_boxes = np.zeros((num_boxes, HII_DIM, HII_DIM, HII_DIM)) 
-new_wedge_filtered_bt_boxes = np.zeros((num_boxes, HII_DIM, HII_DIM, HII_DIM)) 
-redshifts = np.zeros(num_boxes)
-random_seeds = np.zeros(num_boxes)
-counter = 0
-
-# Randomly select n redshifts per random seed
-for i in range(len(fname_coeval_boxes)):
-
-    n = 1
-    DM = DataManager(fname_coeval_boxes[i])
-    np.random.seed(rseeds[i])
-    zs = np.random.choice(np.array(DM.data["redshifts"]), n, replace=False)
-    np.random.seed(rseeds[i])
-    index = np.random.choice(np.arange(np.array(DM.data["redshifts"]).shape[0]), n, replace=False)
-
-    # Ensure redshift matches with index
-    assert(zs == np.array(DM.data["redshifts"])[index])
-
-    # Cast into arrays
-    redshifts[counter:counter+n] = zs
-    random_seeds[counter:counter+n] = rseeds[i]
-    new_wedge_filtered_bt_boxes[counter:counter+n] = np.array(DM.data["wedge_filtered_brightness_temp_boxes"])[index]
-    new_bt_boxes[counter:counter+n] = np.array(DM.data["brightness_temp_boxes"])[index]
-    new_ion_boxes[counter:counter+n] = np.array(DM.data["ionized_boxes"])[index]
-    
-    counter += n
-
-# Shuffle training and validation sets separately
+# Shuffle training and validation sets separately. The permutation only depends on
+# the shuffle seeds, so it is computed up front and each box is written straight
+# into its shuffled slot: output slot p holds input box order[p].
 shuffle_rseed_train = 16
 shuffle_rseed_val = 91
 order = np.arange(0, num_boxes)
@@ -74,16 +49,78 @@ np.random.seed(shuffle_rseed_train)
 np.random.shuffle(order[:num_train])
 np.random.seed(shuffle_rseed_val)
 np.random.shuffle(order[num_train:])
+slots = np.argsort(order)
 
-# Save data using same DM structure
-DM.dset_attrs = {'p21c_initial_conditions': "{'user_params': {'HII_DIM': 128, 'BOX_LEN': 192}}"}
-DM.data = {'brightness_temp_boxes': new_bt_boxes[order], 'ionized_boxes': new_ion_boxes[order], 'redshifts': redshifts[order], 
-          'wedge_filtered_brightness_temp_boxes': new_wedge_filtered_bt_boxes[order], 'random_seeds': random_seeds[order]}
-DM.filepath = fname_save
+box_keys = ['brightness_temp_boxes', 'ionized_boxes', 'wedge_filtered_brightness_temp_boxes']
 
-# Training, validation set # of boxes per redshift
-print('\n Training set breakdown: ', np.unique(DM.data['redshifts'][:num_train], return_counts=True))
-print('\n Validation set breakdown: ', np.unique(DM.data['redshifts'][num_train:], return_counts=True))
+# Storage layout of the boxes (see utility_funcs.box_storage_kwargs). Boxes are
+# stored with the field dtype of the precision policy, the dtype DataManager
+# loads them with (float32 by default, see dtype_policy.py)
+chunks = 'box' # or 'subcube'
+compression = None # or 'lzf' (fast) / 'gzip'
+storage_dtype = get_policy().field # or np.float16
+redshifts = np.zeros(num_boxes)
+random_seeds = np.zeros(num_boxes)
+counter = 0
 
-# Save training set
-save_dset_to_hf(DM.filepath,DM.data,DM.dset_attrs)
+with h5py.File(fname_save, 'w') as hf:
+
+    # Resizable, chunked datasets filled as each per-seed file is read
+    for k in box_keys:
+        hf.create_dataset(k, maxshape=(None, HII_DIM, HII_DIM, HII_DIM),
+                          **box_storage_kwargs((num_boxes, HII_DIM, HII_DIM, HII_DIM), np.float64,
+                                               chunks=chunks, compression=compression,
+                                               storage_dtype=storage_dtype))
+    nbytes, t_write = 0, 0.
+
+    # Randomly select n redshifts per random seed
+    for i in range(len(fname_coeval_boxes)):
+
+        n = 1
+
+        # Read only the redshifts to pick the boxes to keep
+        file_zs = DataManager(fname_coeval_boxes[i], keys=["redshifts"]).data["redshifts"]
+        np.random.seed(rseeds[i])
+        zs = np.random.choice(file_zs, n, replace=False)
+        np.random.seed(rseeds[i])
+        index = np.random.choice(np.arange(file_zs.shape[0]), n, replace=False)
+
+        # Ensure redshift matches with index
+        assert(zs == file_zs[index])
+
+        # Read only the selected boxes, write them into their shuffled slots
+        DM = DataManager(fname_coeval_boxes[i], keys=box_keys, index=index)
+        redshifts[counter:counter+n] = zs
+        random_seeds[counter:counter+n] = rseeds[i]
+        t0 = time.perf_counter()
+        for j in range(n):
+            slot = slots[counter+j]
+            for k in box_keys:
+                hf[k][slot] = DM.data[k][j]
+                nbytes += DM.data[k][j].nbytes
+        t_write += time.perf_counter() - t0
+
+        counter += n
+
+    # Save data using same DM structure
+    dset_attrs = {'p21c_initial_conditions': "{'user_params': {'HII_DIM': 128, 'BOX_LEN': 192}}"}
+    hf.create_dataset('redshifts', data=redshifts[order])
+    hf.create_dataset('random_seeds', data=random_seeds[order])
+    for k, v in dset_attrs.items():
+        hf.attrs[k] = str(v)
+
+    report_write_throughput(hf, box_keys, nbytes, t_write)
+
+    # Training, validation set # of boxes per redshift
+    print('\n Training set breakdown: ', np.unique(redshifts[order][:num_train], return_counts=True))
+    print('\n Validation set breakdown: ', np.unique(redshifts[order][num_train:], return_counts=True))
+
+    print("\n----------\n")
+    print(f"h5py file created at {fname_save}")
+    print("Contents:")
+    for k in hf.keys():
+        print("\t'{}', shape: {}".format(k, hf[k].shape))
+    print("Attributes:")
+    for k in dset_attrs.keys():
+        print("\t'{}': {}".format(k, dset_attrs[k]))
+    print("\n----------\n")
@@ -9,53 +9,67 @@ Description:
 Python script to load perturbed halo fields from 21cmFAST-cache and sort halos
 based on their locations in an ionized vs neutral region of the 21cmFAST generated
 ionization fields (gt) and the U-Net predicted (pred) ionization fields.
+Cache files are located through a persistent attribute index (cache_index.py),
+so only halo fields matching a validation box are read. Sorted halos of all
+boxes are appended to one consolidated catalog (halo_catalog.py). Boxes are
+streamed batch by batch (DataManager.iter_boxes), so the stack of boxes never
+has to fit in memory.
 
 '''
 
-import h5py
 import numpy as np
-from glob import glob
 import py21cmfast as p21c
 import matplotlib.pyplot as plt
 from data_manager import DataManager
+from cache_index import CacheIndex
+from halo_catalog import HaloCatalog
 from utility_funcs import (binarize_boxes, get_n_i_halo_mass_coords)
 
-def get_rseed(fname):
-
-    '''Function to return rseed from .h5 file in the 21cmFAST-cache.'''
-
-    return int(fname.split('_')[-1][1:-3])
-
 # Coeval boxes to analyze 
 coeval_boxes_dir = '/Users/kennedyj/PHYS_459/data/coeval_boxes/'
 fname_coeval_boxes = 'HII_DIM_128_BOX_LEN_192_alpha_15_bar_max_2_168_boxes_new_zs_intermed_rseed_shared_shuffled_training_set_results.h5'
 
-# Cached perturbed halo fields, sorted by increasing random seed
-fname_pt_halo_fields = glob('/Users/kennedyj/21cmFAST-cache/PerturbHaloField*')
-sorted_fname_pt_halo_fields = sorted(fname_pt_halo_fields, key = get_rseed)
+# Index of cached perturbed halo fields, only files added/modified since the last run are read
+cache_index = CacheIndex('/Users/kennedyj/21cmFAST-cache/', pattern='PerturbHaloField*')
 
-# Load in coeval boxes
-DM = DataManager(coeval_boxes_dir + fname_coeval_boxes)
+# Load in coeval boxes, lazily: boxes are streamed in batches of batch_size
+DM = DataManager(coeval_boxes_dir + fname_coeval_boxes, lazy=True)
 redshifts = np.array(DM.data['redshifts']) 
 rseeds = np.array(DM.data['random_seeds_val'])
-xH_boxes_gt = binarize_boxes(DM.data["ionized_boxes"])
-xH_boxes_pred = binarize_boxes(DM.data["predicted_brightness_temp_boxes"])
 num_val_boxes = rseeds.shape[0]
+batch_size = 8
+
+# Join validation boxes against the cache index, only matching halo fields are read
+matches = {}
+for index, fname in cache_index.join(redshifts, rseeds):
+    matches.setdefault(index, []).append(fname)
+
+# All sorted halos of the run go to a single consolidated catalog
+fname_catalog = "/Users/kennedyj/PHYS_459/data/halo_masses_coords/HII_DIM_128_BOX_LEN_192_alpha_15_bar_max_2_168_boxes_new_zs_intermed_UHF_False_halo_catalog.h5"
+
+with HaloCatalog(fname_catalog) as catalog:
+
+    # The next batch of boxes is read in the background while this one is binarized and sorted
+    for batch in DM.iter_boxes(["ionized_boxes", "predicted_brightness_temp_boxes"], batch=batch_size):
+
+        xH_boxes_gt = binarize_boxes(batch["ionized_boxes"], dtype=bool)
+        xH_boxes_pred = binarize_boxes(batch["predicted_brightness_temp_boxes"], dtype=bool)
+
+        for j, index in enumerate(batch['index']):
+
+            for fname in matches.get(index, []):
+
+                # Blocks already in the catalog (e.g. from an earlier run) are skipped
+                if (rseeds[index], redshifts[index]) in catalog:
+                    continue
 
-# Load in cached perturbed halo fields, check if redshift, random seed match with validation coeval boxes
-for i in range(len(fname_pt_halo_fields)):
+                cached_pt_halo_field = p21c.cache_tools.readbox(fname=fname)
 
-    cached_pt_halo_field = p21c.cache_tools.readbox(fname=sorted_fname_pt_halo_fields[i])
-    
-    z = cached_pt_halo_field.redshift
-    rseed = cached_pt_halo_field.random_seed
-    index = np.where((redshifts==z) & (rseeds==rseed))[0]
+                z = cached_pt_halo_field.redshift
+                rseed = cached_pt_halo_field.random_seed
 
-    print(f'\n \n === {(z, rseed)} === \n \n')
+                print(f'\n \n === {z, rseed} === \n \n')
+                get_n_i_halo_mass_coords(cached_pt_halo_field.halo_coords, cached_pt_halo_field.halo_masses, xH_boxes_gt[j], xH_boxes_pred[j], 
+                                         rseeds[index], None, scale=1, catalog=catalog, redshift=redshifts[index])
 
-    # If z, rseed in redshifts, rseeds --> index.size == 1
-    if index.size:
-        
-        print(f'\n \n === {z, rseed} === \n \n')
-        save_name = f"/Users/kennedyj/PHYS_459/data/halo_masses_coords/HII_DIM_128_BOX_LEN_192_alpha_15_bar_max_2_168_boxes_new_zs_intermed_UHF_False_z_{z}_rseed_{rseed}_halos.h5"
-        get_n_i_halo_mass_coords(cached_pt_halo_field.halo_coords, cached_pt_halo_field.halo_masses, xH_boxes_gt[index][0], xH_boxes_pred[index][0], rseed, save_name, scale=1)
+DM.close()
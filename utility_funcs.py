@@ -11,41 +11,187 @@ Functions are imported into other modules.
 
 '''
 
+import os
+import time
 import h5py
 import numpy as np
 from typing import Optional, List
+from dtype_policy import get_policy
 
-def binarize_boxes(xH_boxes, cutoff=0.9): # binarize ionized boxes, neutral maps to 1, ionized to 0
+def binarize_boxes(xH_boxes, cutoff=0.9, dtype=None, out=None, inplace=False, packbits=False): # binarize ionized boxes, neutral maps to 1, ionized to 0
     
     '''
     Function to binarize ionization fields, mapping voxels above
     the cutoff value to 1 (neutral) and voxels below the cutoff
-    value to 0 (ionized).
+    value to 0 (ionized). Boxes are read and binarized one at a time, so
+    xH_boxes may be a lazy DataManager view (np.memmap or h5py Dataset).
     ------------------------------------------------------------------------------
     xH_boxes:
             Ionization field(s).
     cutoff:
-            Binarization cutoff value, default = 0.0.
+            Binarization cutoff value, default = 0.9.
+    dtype:
+            Output dtype, default = None, the mask dtype of the precision
+            policy (bool for float32, np.float64 for float64, see dtype_policy.py).
+    out:
+            Optional preallocated array (or h5py Dataset) to write into.
+    inplace:
+            If True, overwrite xH_boxes with the binarized values.
+    packbits:
+            If True, return np.packbits masks (uint8, 1 bit per voxel) packed
+            along the last axis, see unpack_binarized_boxes.
     ------------------------------------------------------------------------------
     ''' 
     
     num_box = xH_boxes.shape[0]
-    binarized_boxes = np.zeros(xH_boxes.shape)
+
+    if inplace:
+        if packbits:
+            raise ValueError("packbits output cannot be written in place.")
+        out = xH_boxes
+
+    if out is None:
+        if packbits:
+            shape = xH_boxes.shape[:-1] + ((xH_boxes.shape[-1] + 7) // 8,)
+            out = np.empty(shape, dtype=np.uint8)
+        else:
+            out = np.empty(xH_boxes.shape, dtype=get_policy().mask if dtype is None else dtype)
     
     for i in range(num_box):
         
-        sup_threshold_inds = (xH_boxes[i] >= cutoff) # map to 1
-        sub_threshold_inds = (xH_boxes[i] < cutoff) # map to 0
-        binarized_boxes[i][sup_threshold_inds] = 1 
-        binarized_boxes[i][sub_threshold_inds] = 0
+        neutral = np.asarray(xH_boxes[i]) >= cutoff # map to 1, rest to 0
+        out[i] = np.packbits(neutral, axis=-1) if packbits else neutral
         
-    return binarized_boxes
+    return out
+
+def iter_binarized_boxes(xH_boxes, cutoff=0.9, dtype=bool):
+
+    '''
+    Generator yielding binarized ionization fields box by box, holding
+    a single box in memory at a time.
+    ------------------------------------------------------------------------------
+    xH_boxes:
+            Ionization field(s), e.g. a lazy DataManager dataset.
+    cutoff:
+            Binarization cutoff value, default = 0.9.
+    dtype:
+            Output dtype, default = bool.
+    ------------------------------------------------------------------------------
+    '''
+
+    for i in range(xH_boxes.shape[0]):
+        yield (np.asarray(xH_boxes[i]) >= cutoff).astype(dtype, copy=False)
+
+def unpack_binarized_boxes(packed_boxes, dim, dtype=bool):
+
+    '''
+    Function to unpack boxes binarized with packbits=True.
+    ------------------------------------------------------------------------------
+    packed_boxes:
+            Bit-packed binarized ionization field(s).
+    dim:
+            Length of the last (packed) axis of the original boxes.
+    dtype:
+            Output dtype, default = bool.
+    ------------------------------------------------------------------------------
+    '''
+
+    return np.unpackbits(packed_boxes, axis=-1, count=dim).astype(dtype, copy=False)
     
-def get_n_i_halo_mass_coords(halocoords, halomasses, gt_ionizedbox, pred_ionizedbox, rseed, save_name, scale=3):
+def label_n_i_halos(halocoords, gt_ionizedbox, pred_ionizedbox, scale=3, box_inds=None):
+
+    '''
+    Function to label halos as lying in a neutral (True) or ionized (False)
+    region of the ground-truth and predicted ionization fields, gathering
+    the box values at every halo location in a single indexed read.
+    ------------------------------------------------------------------------------
+    halocoords:
+            Coordinates of halos in box.
+    gt_ionizedbox:
+            Ground-truth (21cmFAST output) binarized ionization field, or a
+            stack of fields with box_inds.
+    pred_ionizedbox:
+            Predicted (U-Net output) binarized ionization field, or a stack of
+            fields with box_inds.
+    scale:
+            DIM//HII_DIM (int), default = 3.
+    box_inds:
+            Optional index into the stacks of the box of each halo.
+    ------------------------------------------------------------------------------
+    Returns the low-res halo coordinates and the gt/pred neutral labels.
+    '''
+
+    # Need to scale down dim from high to low res
+    halo_low_res_coords = np.asarray(halocoords).reshape(-1, 3) // scale
+    index = tuple(halo_low_res_coords.T)
+    if box_inds is not None:
+        index = (np.asarray(box_inds),) + index
+
+    # Check if halo in neutral or ionized region of gt/pred fields (neutral = 1, ionized = 0)
+    gt_neutral = np.asarray(gt_ionizedbox)[index] == 1
+    pred_neutral = np.asarray(pred_ionizedbox)[index] == 1
+
+    return halo_low_res_coords, gt_neutral, pred_neutral
+
+def split_n_i_halos(halo_low_res_coords, halomasses, gt_neutral, pred_neutral):
+
+    '''
+    Function to split labelled halos into the ionized and neutral regions of
+    the ground-truth and predicted ionization fields with boolean masks,
+    preserving the original halo order. Returns a dict of the eight
+    {gt,pred}_{neutral,ionized}_halo_{masses,coords} arrays, with the coords
+    and mass dtypes of the precision policy.
+    '''
+
+    policy = get_policy()
+    halomasses = np.asarray(halomasses, dtype=policy.mass)
+    halo_low_res_coords = halo_low_res_coords.astype(policy.coords_dtype(halo_low_res_coords))
+
+    return {'pred_neutral_halo_masses': halomasses[pred_neutral],
+            'pred_ionized_halo_masses': halomasses[~pred_neutral],
+            'pred_neutral_halo_coords': halo_low_res_coords[pred_neutral],
+            'pred_ionized_halo_coords': halo_low_res_coords[~pred_neutral],
+            'gt_neutral_halo_masses': halomasses[gt_neutral],
+            'gt_ionized_halo_masses': halomasses[~gt_neutral],
+            'gt_neutral_halo_coords': halo_low_res_coords[gt_neutral],
+            'gt_ionized_halo_coords': halo_low_res_coords[~gt_neutral]}
+
+def sort_n_i_halos(halocoords, halomasses, gt_ionizedbox, pred_ionizedbox, scale=3):
+
+    '''
+    Function to sort halos into the ionized and neutral regions of the
+    ground-truth and predicted ionization fields. Box values at every halo
+    location are gathered in a single indexed read and the four classes
+    are built with boolean masks, preserving the original halo order.
+    ------------------------------------------------------------------------------
+    halocoords:
+            Coordinates of halos in box.
+    halomasses:
+            Masses of halos in box.
+    gt_ionizedbox:
+            Ground-truth (21cmFAST output) binarized ionization field.
+    pred_ionizedbox:
+            Predicted (U-Net output) binarized ionization field.
+    scale:
+            DIM//HII_DIM (int), default = 3.
+    ------------------------------------------------------------------------------
+    Returns a dict of the eight {gt,pred}_{neutral,ionized}_halo_{masses,coords}
+    arrays, with the coords and mass dtypes of the precision policy.
+    '''
+
+    halo_low_res_coords, gt_neutral, pred_neutral = label_n_i_halos(halocoords, gt_ionizedbox,
+                                                                    pred_ionizedbox, scale=scale)
+
+    return split_n_i_halos(halo_low_res_coords, halomasses, gt_neutral, pred_neutral)
+
+def get_n_i_halo_mass_coords(halocoords, halomasses, gt_ionizedbox, pred_ionizedbox, rseed, save_name, scale=3,
+                             catalog=None, redshift=None):
     
     '''
     Function to find the halo coordinates and masses of halos 
     found in the ionized and neutral regions of ionization field.
+    If a HaloCatalog is given, the halos are appended to it as one
+    (rseed, redshift) block instead of being written to save_name.
     ------------------------------------------------------------------------------
     halocoords: 
          Coordinates of halos in box.
@@ -59,128 +205,228 @@ def get_n_i_halo_mass_coords(halocoords, halomasses, gt_ionizedbox, pred_ionized
             Name to save .h5 to.
     scale:
             DIM//HII_DIM (int), default = 3.
+    catalog:
+            Optional halo_catalog.HaloCatalog to append to.
+    redshift:
+            Redshift of the box, required with catalog.
     ------------------------------------------------------------------------------
     ''' 
-     
-    # Need to scale down dim from high to low res
-    halo_low_res_coords = halocoords // scale
-    num_halos = len(halomasses)
-    
-    # Maximum number of each class of halos is num_halos
-    pred_neutral_halo_coords = np.zeros(shape=(num_halos, 3))
-    pred_neutral_halo_masses = np.zeros(shape=num_halos)
-    pred_ionized_halo_coords = np.zeros(shape=(num_halos, 3))
-    pred_ionized_halo_masses = np.zeros(shape=num_halos)
-    gt_neutral_halo_coords = np.zeros(shape=(num_halos, 3))
-    gt_neutral_halo_masses = np.zeros(shape=num_halos)
-    gt_ionized_halo_coords = np.zeros(shape=(num_halos, 3))
-    gt_ionized_halo_masses = np.zeros(shape=num_halos)
-    
-    pred_ion_count = 0
-    pred_ntl_count = 0
-    gt_ion_count = 0
-    gt_ntl_count = 0
-    
-    # Check if halo in neutral or ionized region of gt/pred fields (neutral = 1, ionized = 0)
-    for i in range(num_halos): 
-    
-        x = halo_low_res_coords[i][0]
-        y = halo_low_res_coords[i][1]
-        z = halo_low_res_coords[i][2]
-        
-        if (pred_ionizedbox[x,y,z] == 1) and (gt_ionizedbox[x,y,z] == 1):
-        
-            pred_neutral_halo_coords[pred_ntl_count]=np.array([x,y,z])
-            pred_neutral_halo_masses[pred_ntl_count]=halomasses[i]
-            pred_ntl_count +=1 
 
-            gt_neutral_halo_coords[gt_ntl_count]=np.array([x,y,z])
-            gt_neutral_halo_masses[gt_ntl_count]=halomasses[i]
-            gt_ntl_count +=1  
-        
-        elif (pred_ionizedbox[x,y,z] == 1) and (gt_ionizedbox[x,y,z] != 1):  
-            
-            pred_neutral_halo_coords[pred_ntl_count]=np.array([x,y,z])
-            pred_neutral_halo_masses[pred_ntl_count]=halomasses[i]
-            pred_ntl_count +=1
-             
-            gt_ionized_halo_coords[gt_ion_count]=np.array([x,y,z])
-            gt_ionized_halo_masses[gt_ion_count]=halomasses[i]
-            gt_ion_count +=1
-        
-        elif (pred_ionizedbox[x,y,z] != 1) and (gt_ionizedbox[x,y,z] == 1):
-        
-            pred_ionized_halo_coords[pred_ion_count]=np.array([x,y,z])
-            pred_ionized_halo_masses[pred_ion_count]=halomasses[i]
-            pred_ion_count +=1
-            
-            gt_neutral_halo_coords[gt_ntl_count]=np.array([x,y,z])
-            gt_neutral_halo_masses[gt_ntl_count]=halomasses[i]
-            gt_ntl_count +=1 
-            
-        else:
-        
-            pred_ionized_halo_coords[pred_ion_count]=np.array([x,y,z])
-            pred_ionized_halo_masses[pred_ion_count]=halomasses[i]
-            pred_ion_count +=1
-            
-            gt_ionized_halo_coords[gt_ion_count]=np.array([x,y,z])
-            gt_ionized_halo_masses[gt_ion_count]=halomasses[i]
-            gt_ion_count +=1
-    
-    # remove left-over zeros
-    pred_neutral_halo_masses = np.trim_zeros(pred_neutral_halo_masses,'b')  
-    pred_ionized_halo_masses = np.trim_zeros(pred_ionized_halo_masses,'b') 
-    pred_neutral_halo_coords = pred_neutral_halo_coords[:len(pred_neutral_halo_masses)]
-    pred_ionized_halo_coords = pred_ionized_halo_coords[:len(pred_ionized_halo_masses)]
-    
-    gt_neutral_halo_masses = np.trim_zeros(gt_neutral_halo_masses,'b')  
-    gt_ionized_halo_masses = np.trim_zeros(gt_ionized_halo_masses,'b') 
-    gt_neutral_halo_coords = gt_neutral_halo_coords[:len(gt_neutral_halo_masses)]
-    gt_ionized_halo_coords = gt_ionized_halo_coords[:len(gt_ionized_halo_masses)]
-    
-    # save to .h5 file
-    hf = h5py.File(save_name, 'w')
-    
-    hf.create_dataset('pred_neutral_halo_masses', data=pred_neutral_halo_masses)
-    hf.create_dataset('pred_ionized_halo_masses', data=pred_ionized_halo_masses)
-    hf.create_dataset('pred_neutral_halo_coords', data=pred_neutral_halo_coords)
-    hf.create_dataset('pred_ionized_halo_coords', data=pred_ionized_halo_coords)
-    hf.create_dataset('gt_neutral_halo_masses', data=gt_neutral_halo_masses)
-    hf.create_dataset('gt_ionized_halo_masses', data=gt_ionized_halo_masses)
-    hf.create_dataset('gt_neutral_halo_coords', data=gt_neutral_halo_coords)
-    hf.create_dataset('gt_ionized_halo_coords', data=gt_ionized_halo_coords)
+    if catalog is not None:
+        coords, gt_neutral, pred_neutral = label_n_i_halos(halocoords, gt_ionizedbox,
+                                                           pred_ionizedbox, scale=scale)
+        catalog.append(rseed, redshift, coords, halomasses, gt_neutral, pred_neutral)
+        print(f"\n ======= (rseed, z) = {(rseed, redshift)} appended to {catalog.filename}. ======= \n")
+        return
+
+    save_n_i_halos(sort_n_i_halos(halocoords, halomasses, gt_ionizedbox, pred_ionizedbox, scale=scale),
+                   rseed, save_name)
+
+def save_n_i_halos(sorted_halos, rseed, save_name):
+
+    '''
+    Function to write the sorted halos of one box (as returned by
+    sort_n_i_halos) and its random seed to save_name.
+    '''
+
+    # save to a temporary .h5 file, then move into place so that an interrupted
+    # write never leaves a partial file at save_name
+    tmp_name = save_name + '.tmp'
+    hf = h5py.File(tmp_name, 'w')
+
+    for k, v in sorted_halos.items():
+        hf.create_dataset(k, data=v)
     hf.create_dataset('random_seed', data=rseed)
+
+    hf.close()
+    os.replace(tmp_name, save_name)
     
     print(f"\n ======= All datasets created, saved to {save_name}. ======= \n")
 
-    hf.close()
+def n_i_halo_file_complete(save_name):
+
+    '''
+    Function to check whether a get_n_i_halo_mass_coords output file exists,
+    can be opened and holds every sorted halo dataset.
+    ------------------------------------------------------------------------------
+    save_name:
+            Name of the .h5 file to check.
+    ------------------------------------------------------------------------------
+    '''
+
+    if not os.path.isfile(save_name):
+        return False
+
+    keys = [f'{truth}_{region}_halo_{q}' for truth in ('gt', 'pred')
+            for region in ('neutral', 'ionized') for q in ('masses', 'coords')]
+    try:
+        with h5py.File(save_name, 'r') as hf:
+            return all(k in hf for k in keys + ['random_seed'])
+    except OSError:
+        return False
+
+def get_n_i_halo_mass_coords_batch(halocoords, halomasses, gt_ionizedboxes, pred_ionizedboxes, rseeds, save_names, scale=3,
+                                   catalog=None, redshifts=None):
+
+    '''
+    Function to sort the halos of several boxes/random seeds in one call,
+    writing one .h5 file per box as get_n_i_halo_mass_coords does. The halo
+    coordinates of all boxes are concatenated with their box index, and the
+    gt/pred values of every halo are gathered from the stacked boxes in one
+    indexed read.
+    ------------------------------------------------------------------------------
+    halocoords:
+            Sequence of halo coordinate arrays, one per box.
+    halomasses:
+            Sequence of halo mass arrays, one per box.
+    gt_ionizedboxes:
+            Stack of ground-truth binarized ionization fields (np.memmap or array).
+    pred_ionizedboxes:
+            Stack of predicted binarized ionization fields (np.memmap or array).
+    rseeds:
+            Random seed of each box.
+    save_names:
+            Name to save each .h5 to, may be None with catalog.
+    scale:
+            DIM//HII_DIM (int), default = 3.
+    catalog:
+            Optional halo_catalog.HaloCatalog to append to.
+    redshifts:
+            Redshift of each box, required with catalog.
+    ------------------------------------------------------------------------------
+    '''
+
+    halocoords = [np.asarray(c).reshape(-1, 3) for c in halocoords]
+    bounds = np.cumsum([0] + [len(c) for c in halocoords])
+    box_inds = np.repeat(np.arange(len(halocoords)), np.diff(bounds))
+
+    coords, gt_neutral, pred_neutral = label_n_i_halos(np.concatenate(halocoords), gt_ionizedboxes,
+                                                       pred_ionizedboxes, scale=scale, box_inds=box_inds)
+
+    for k in range(len(rseeds)):
+        box = slice(bounds[k], bounds[k+1])
+        if catalog is not None:
+            catalog.append(rseeds[k], redshifts[k], coords[box], halomasses[k], gt_neutral[box], pred_neutral[box])
+            print(f"\n ======= (rseed, z) = {(rseeds[k], redshifts[k])} appended to {catalog.filename}. ======= \n")
+        else:
+            save_n_i_halos(split_n_i_halos(coords[box], halomasses[k], gt_neutral[box], pred_neutral[box]),
+                           rseeds[k], save_names[k])
+
+def box_storage_kwargs(shape, dtype, chunks='box', compression=None,
+                       storage_dtype=None, shuffle=None, subcube=64):
+
+    '''
+    Function to return the h5py create_dataset keyword arguments for a stack of
+    boxes of the given shape, e.g. (num_boxes, D, D, D).
+    ------------------------------------------------------------------------------
+    shape, dtype:
+            Shape and in-memory dtype of the dataset.
+    chunks:
+            'box' for one chunk per box (1, D, D, D), 'subcube' for (1, s, s, s)
+            sub-cubes (s = min(subcube, D)), None for a contiguous layout or an
+            explicit chunk shape, default = 'box'.
+    compression:
+            None, 'lzf' (fast) or 'gzip', default = None.
+    storage_dtype:
+            On-disk dtype of floating point boxes, e.g. np.float32 or
+            np.float16, default = None (keep dtype).
+    shuffle:
+            Apply the shuffle filter, default = None (on with compression).
+    ------------------------------------------------------------------------------
+    '''
+
+    shape = tuple(shape)
+    kwargs = {'shape': shape, 'dtype': dtype}
+
+    # Storage policy and chunking only apply to stacks of boxes, small datasets
+    # (e.g. redshifts) are stored as is
+    if len(shape) >= 3 and shape[0] > 0:
+        if storage_dtype is not None and np.issubdtype(dtype, np.floating):
+            kwargs['dtype'] = np.dtype(storage_dtype)
+
+        if chunks == 'box':
+            kwargs['chunks'] = (1,) + shape[1:]
+        elif chunks == 'subcube':
+            kwargs['chunks'] = (1,) + tuple(min(subcube, d) for d in shape[1:])
+        elif chunks is not None:
+            kwargs['chunks'] = tuple(chunks)
+
+        if compression is not None:
+            kwargs['compression'] = compression
+            kwargs['shuffle'] = True if shuffle is None else shuffle
+        elif shuffle:
+            kwargs['shuffle'] = True
+
+    return kwargs
+
+def report_write_throughput(hf, keys, nbytes, seconds):
+
+    '''
+    Function to print the write throughput of datasets keys of hf: in-memory
+    bytes written per second and the stored size (after dtype conversion and
+    compression) relative to the in-memory size.
+    '''
+
+    stored = sum(hf[k].id.get_storage_size() for k in keys)
+    print(f"\n ====== Wrote {nbytes/1024**2:.1f} MiB in {seconds:.2f} s "
+          f"({nbytes/1024**2/max(seconds, 1e-9):.1f} MiB/s), stored {stored/1024**2:.1f} MiB "
+          f"({stored/max(nbytes, 1):.2f}x) ====== \n")
+    for k in keys:
+        dset = hf[k]
+        print(f"\t'{k}': {dset.dtype}, chunks {dset.chunks}, compression {dset.compression}, "
+              f"shuffle {dset.shuffle}, {dset.id.get_storage_size()/1024**2:.1f} MiB")
 
 def save_dset_to_hf(filename: str, data: dict,
-                    attrs: Optional[dict] = None):
+                    attrs: Optional[dict] = None, chunks='box',
+                    compression: Optional[str] = None, storage_dtype=None,
+                    shuffle: Optional[bool] = None, report: bool = True):
     """
     Author: @j-c-carr
 
     Saves coeval boxes (brightness temperature and xh_boxes) and corresponding
-    wedge-filtered coeval boxes to an h5py dataset.
+    wedge-filtered coeval boxes to an h5py dataset. Stacks of boxes are written
+    one box at a time with the layout of box_storage_kwargs.
     ----------
     Params:
     :filename: Filepath of saved data.
     :data:     All datasets to store (eg. brightness temperature boxes)
     :attrs:    Optional (small) data to be stored as h5py Attribute.
+    :chunks:   'box', 'subcube', None or a chunk shape, see box_storage_kwargs.
+    :compression:   None, 'lzf' or 'gzip'.
+    :storage_dtype: On-disk dtype of floating point boxes, e.g. np.float32.
+    :shuffle:  Apply the shuffle filter (default: with compression).
+    :report:   Print the write throughput and stored size.
     """
 
+    nbytes, seconds = 0, 0.
+
     with h5py.File(filename, "w") as hf:
 
         # Save datasets
         for k, v in data.items():
-            hf.create_dataset(k, data=v)
+            v = np.asarray(v)
+            kwargs = box_storage_kwargs(v.shape, v.dtype, chunks=chunks, compression=compression,
+                                        storage_dtype=storage_dtype, shuffle=shuffle)
+            t0 = time.perf_counter()
+            if v.ndim >= 3:
+                dset = hf.create_dataset(k, **kwargs)
+                for i in range(v.shape[0]):
+                    dset[i] = v[i]
+            else:
+                kwargs.pop('shape')
+                hf.create_dataset(k, data=v.astype(kwargs.pop('dtype'), copy=False), **kwargs)
+            hf.flush()
+            seconds += time.perf_counter() - t0
+            nbytes += v.nbytes
 
         # Save attributes
         if attrs is not None:
             for k, v in attrs.items():
                 hf.attrs[k] = str(v)
 
+        if report:
+            report_write_throughput(hf, list(data.keys()), nbytes, seconds)
+
     # On success
     print("\n----------\n")
     print(f"h5py file created at {filename}")
@@ -188,6 +434,6 @@ def save_dset_to_hf(filename: str, data: dict,
     for k in data.keys():
         print("\t'{}', shape: {}".format(k, data[k].shape))
     print("Attributes:")
-    for k in attrs.keys():
+    for k in (attrs or {}).keys():
         print("\t'{}': {}".format(k, attrs[k]))
     print("\n----------\n")